@@ -8,8 +8,10 @@ from threading import Thread
 
 from bot.run_check_subscriptions import sending_notifications
 from parser.main import run_parser
+from utils.warm_up_charts import warming_up_charts
 
 
 def run():
     Thread(target=run_parser).start()
     Thread(target=sending_notifications).start()
+    Thread(target=warming_up_charts).start()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Замер времени запуска: импорт точек входа по данным python -X importtime
+# и время от старта интерпретатора до момента перед updater.start_polling().
+# Каждый замер выполняется в отдельном процессе, чтобы модули не были уже загружены.
+# Запуск: python benchmark_startup.py [<количество повторов>]
+
+
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+
+DIR = Path(__file__).resolve().parent
+
+MODULES: list[str] = [
+    "main",
+    "parser.main",
+    "bot.run_check_subscriptions",
+]
+
+# Все, что делает main.main() до start_polling, но без обращений к Telegram
+CODE_BEFORE_POLLING: str = """
+import time
+t = time.perf_counter()
+
+from telegram.ext import Updater, Defaults
+import db
+from bot import commands
+
+db.init()
+
+updater = Updater("123456:TOKEN", workers=os.cpu_count(), defaults=Defaults(run_async=True))
+commands.setup(updater.dispatcher)
+
+print(time.perf_counter() - t)
+"""
+
+
+def run_python(args: list[str]) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=str(DIR), TOKEN="123456:TOKEN")
+    return subprocess.run(
+        [sys.executable, *args],
+        cwd=DIR, env=env, capture_output=True, text=True, check=True,
+    )
+
+
+def get_import_times(module: str) -> list[tuple[str, int]]:
+    """
+    Кумулятивное время импорта (мкс) для модуля и модулей, которые он импортирует напрямую
+    """
+
+    result = run_python(["-X", "importtime", "-c", f"import {module}"])
+
+    items = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+        items.append((name.rstrip(), int(cumulative)))
+
+    return items
+
+
+def run(number: int = 5):
+    for module in MODULES:
+        items = get_import_times(module)
+
+        def get_indent(name: str) -> int:
+            return len(name) - len(name.lstrip())
+
+        # Модуль печатается последним, его прямые зависимости - с отступом на уровень глубже
+        name, total = items[-1]
+        indent = get_indent(name)
+        children = [
+            (name.strip(), cumulative)
+            for name, cumulative in items
+            if get_indent(name) == indent + 2
+        ]
+        children.sort(key=lambda x: x[1], reverse=True)
+
+        print(f"import {module}: {total / 1000:.0f} мс")
+        for name, cumulative in children[:5]:
+            print(f"    {name}: {cumulative / 1000:.0f} мс")
+
+    elapsed = [
+        float(run_python(["-c", "import os\n" + CODE_BEFORE_POLLING]).stdout)
+        for _ in range(number)
+    ]
+    print(
+        f"\nДо start_polling: медиана {statistics.median(elapsed) * 1000:.0f} мс, "
+        f"минимум {min(elapsed) * 1000:.0f} мс ({number} запусков)"
+    )
+
+
+if __name__ == "__main__":
+    run(number=int(sys.argv[1]) if len(sys.argv) > 1 else 5)
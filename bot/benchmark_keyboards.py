@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Время построения inline-клавиатур: как раньше (fill_string_pattern на каждую кнопку),
+# с готовыми шаблонами callback_data без кэша и повторное построение из кэша.
+# Запуск: python bot/benchmark_keyboards.py [<количество повторов>]
+
+
+import sys
+import time
+from typing import Callable
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import db
+from bot import commands
+from bot.regexp_patterns import (
+    PATTERN_INLINE_GET_CHART_CURRENCY_BY_NUMBER,
+    PATTERN_INLINE_GET_CHART_CURRENCY_BY_YEAR,
+    CALLBACK_IGNORE,
+    fill_string_pattern,
+)
+from root_common import split_list
+
+
+def get_inline_keyboard_for_number_pagination_old(
+    current_currency_char_code: str,
+    current_number: int,
+    selected_currencies: tuple[str, ...],
+) -> InlineKeyboardMarkup:
+    # Построение клавиатуры до появления шаблонов и кэша
+    pattern = PATTERN_INLINE_GET_CHART_CURRENCY_BY_NUMBER
+
+    buttons = []
+    for row in split_list(selected_currencies, columns=commands.COLUMNS_FOR_CURRENCY):
+        buttons.append([])
+        for currency_char_code in row:
+            is_current = current_currency_char_code == currency_char_code
+            buttons[-1].append(
+                InlineKeyboardButton(
+                    text=commands.FORMAT_CURRENT.format(currency_char_code) if is_current else currency_char_code,
+                    callback_data=fill_string_pattern(
+                        pattern,
+                        CALLBACK_IGNORE if is_current else currency_char_code,
+                        CALLBACK_IGNORE if is_current else current_number,
+                    ),
+                )
+            )
+
+    buttons.append([
+        InlineKeyboardButton(
+            text="Посмотреть за определенный год",
+            callback_data=fill_string_pattern(
+                PATTERN_INLINE_GET_CHART_CURRENCY_BY_YEAR, current_currency_char_code, -1,
+            ),
+        )
+    ])
+    return InlineKeyboardMarkup(buttons)
+
+
+def measure(func: Callable, number: int, before: Callable = None) -> float:
+    t = time.perf_counter()
+    for _ in range(number):
+        if before:
+            before()
+        func()
+    return (time.perf_counter() - t) / number
+
+
+def run(number: int = 10_000):
+    selected_currencies = tuple(db.Currency.get_all_char_codes())
+    currency_by_enabled = tuple((char_code, True) for char_code in selected_currencies)
+    print(f"Валют в клавиатуре: {len(selected_currencies)}, повторов: {number}")
+
+    def clear_caches():
+        commands.get_buttons_for_selected_currencies.cache_clear()
+        commands._get_inline_keyboard_for_number_pagination.cache_clear()
+        commands._get_inline_keyboard_for_year_pagination.cache_clear()
+        commands.get_inline_keyboard_for_settings.cache_clear()
+
+    items = [
+        (
+            "Графики по количеству",
+            lambda: get_inline_keyboard_for_number_pagination_old("USD", 7, selected_currencies),
+            lambda: commands._get_inline_keyboard_for_number_pagination("USD", 7, selected_currencies),
+        ),
+        (
+            "Графики по годам",
+            None,
+            lambda: commands._get_inline_keyboard_for_year_pagination("USD", 2021, selected_currencies, 2020, None),
+        ),
+        (
+            "Настройки",
+            None,
+            lambda: commands.get_inline_keyboard_for_settings(currency_by_enabled),
+        ),
+    ]
+    for title, func_old, func in items:
+        print(f"\n{title}:")
+        if func_old:
+            print(f"    fill_string_pattern, без кэша: {measure(func_old, number) * 1_000_000:.1f} мкс")
+        print(f"    шаблоны, без кэша: {measure(func, number, before=clear_caches) * 1_000_000:.1f} мкс")
+        print(f"    шаблоны, из кэша: {measure(func, number) * 1_000_000:.1f} мкс")
+
+
+if __name__ == "__main__":
+    db.init()
+    run(number=int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, TypeVar
+
+from telegram import Bot, Message
+from telegram.error import RetryAfter
+
+from root_common import TokenBucket
+
+
+# SOURCE: https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_MESSAGES_PER_SECOND: float = 30
+CHAT_MESSAGES_PER_SECOND: float = 1
+
+WORKERS: int = 8
+MAX_RETRY_AFTER_ATTEMPTS: int = 5
+
+T = TypeVar("T")
+
+
+class Broadcaster:
+    """
+    Рассылка сообщений несколькими потоками с учетом ограничений Telegram:
+    общего на бота и отдельного на каждый чат
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        workers: int = WORKERS,
+        messages_per_second: float = GLOBAL_MESSAGES_PER_SECOND,
+        chat_messages_per_second: float = CHAT_MESSAGES_PER_SECOND,
+        log: logging.Logger = None,
+    ):
+        self.bot = bot
+        self.workers = workers
+        self.chat_messages_per_second = chat_messages_per_second
+        self.log = log
+
+        self.bucket = TokenBucket(rate=messages_per_second)
+
+        self._bucket_by_chat_id: dict[int, TokenBucket] = dict()
+        self._lock = threading.Lock()
+
+    def _get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        with self._lock:
+            bucket = self._bucket_by_chat_id.get(chat_id)
+            if not bucket:
+                bucket = TokenBucket(rate=self.chat_messages_per_second)
+                self._bucket_by_chat_id[chat_id] = bucket
+
+            return bucket
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> Message:
+        chat_bucket = self._get_chat_bucket(chat_id)
+
+        attempt = 1
+        while True:
+            chat_bucket.acquire()
+            self.bucket.acquire()
+
+            try:
+                return self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+
+            except RetryAfter as e:
+                if attempt >= MAX_RETRY_AFTER_ATTEMPTS:
+                    raise e
+
+                if self.log:
+                    self.log.warning(
+                        f"Превышен лимит отправки, пауза на {e.retry_after} секунд"
+                    )
+
+                # Паузу нужно выдержать для всех потоков, а не только для текущего
+                self.bucket.pause(e.retry_after)
+                attempt += 1
+
+    def run(self, func: Callable[[T], None], items: Iterable[T]) -> int:
+        """
+        Вызов func для каждого элемента в пуле потоков.
+        Ошибки логируются и не прерывают рассылку. Возвращает количество успешных вызовов
+        """
+
+        def process(item: T) -> bool:
+            try:
+                func(item)
+                return True
+            except Exception:
+                if self.log:
+                    self.log.exception(f"Ошибка при рассылке для {item}:")
+                return False
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return sum(executor.map(process, items))
+
+
+if __name__ == "__main__":
+    class FakeBot:
+        def __init__(self, retry_after_on: int = -1, retry_after: float = 1):
+            self.timestamps: list[float] = []
+            self.chat_ids: list[int] = []
+            self.retry_after_on = retry_after_on
+            self.retry_after = retry_after
+            self._lock = threading.Lock()
+
+        def send_message(self, chat_id: int, text: str, **kwargs):
+            with self._lock:
+                if len(self.timestamps) == self.retry_after_on:
+                    self.retry_after_on = -1
+                    raise RetryAfter(self.retry_after)
+
+                self.timestamps.append(time.monotonic())
+                self.chat_ids.append(chat_id)
+
+    def get_max_per_second(timestamps: list[float]) -> int:
+        timestamps = sorted(timestamps)
+        return max(
+            sum(1 for t in timestamps[i:] if t - start < 1)
+            for i, start in enumerate(timestamps)
+        )
+
+    bot = FakeBot()
+    broadcaster = Broadcaster(bot, messages_per_second=30)
+    t = time.monotonic()
+    assert broadcaster.run(lambda chat_id: broadcaster.send_message(chat_id, "text"), range(90)) == 90
+    print(f"90 сообщений за {time.monotonic() - t:.2f} секунд")
+    assert sorted(bot.chat_ids) == list(range(90))
+    assert get_max_per_second(bot.timestamps) <= 31
+
+    # Несколько сообщений в один чат не чаще раза в секунду
+    bot = FakeBot()
+    broadcaster = Broadcaster(bot)
+    broadcaster.run(lambda chat_id: broadcaster.send_message(chat_id, "text"), [1, 1, 1])
+    assert get_max_per_second(bot.timestamps) == 1
+
+    # После RetryAfter все потоки ждут
+    bot = FakeBot(retry_after_on=10, retry_after=2)
+    broadcaster = Broadcaster(bot)
+    broadcaster.run(lambda chat_id: broadcaster.send_message(chat_id, "text"), range(20))
+    assert len(bot.timestamps) == 20
+    assert bot.timestamps[10] - bot.timestamps[9] >= 1.9
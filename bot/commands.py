@@ -5,7 +5,9 @@ __author__ = "ipetrash"
 
 
 import datetime as DT
-import re
+from functools import lru_cache
+from io import BytesIO
+from typing import Optional, Union
 
 # pip install python-telegram-bot
 from telegram import (
@@ -16,6 +18,7 @@ from telegram import (
     InlineKeyboardButton,
     ReplyMarkup,
     InputMediaPhoto,
+    Message,
 )
 from telegram.error import BadRequest
 from telegram.ext import (
@@ -38,10 +41,12 @@ from bot.common import (
     SeverityEnum,
     SubscriptionResultEnum,
     is_equal_inline_keyboards,
+    FingerprintInlineKeyboardMarkup,
 )
 from root_common import get_date_str, split_list
 from bot.regexp_patterns import (
     PATTERN_INLINE_GET_BY_DATE,
+    FORMAT_INLINE_GET_BY_DATE,
     PATTERN_REPLY_COMMAND_SUBSCRIBE,
     REPLY_COMMAND_SUBSCRIBE,
     PATTERN_REPLY_COMMAND_UNSUBSCRIBE,
@@ -55,18 +60,23 @@ from bot.regexp_patterns import (
     PATTERN_REPLY_COMMAND_GET_ALL,
     REPLY_COMMAND_GET_ALL,
     PATTERN_INLINE_GET_CHART_CURRENCY_BY_NUMBER,
+    FORMAT_INLINE_GET_CHART_CURRENCY_BY_NUMBER,
     COMMAND_SETTINGS,
+    COMMAND_THRESHOLD,
     PATTERN_REPLY_SETTINGS,
     COMMAND_ADMIN_STATS,
     PATTERN_REPLY_ADMIN_STATS,
     PATTERN_REPLY_SELECT_DATE,
+    REPLY_SELECT_DATE,
     PATTERN_INLINE_SELECT_DATE,
     PATTERN_INLINE_GET_CHART_CURRENCY_BY_YEAR,
+    FORMAT_INLINE_GET_CHART_CURRENCY_BY_YEAR,
     PATTERN_INLINE_SETTINGS_SELECT_CURRENCY_CHAR_CODE,
+    FORMAT_INLINE_SETTINGS_SELECT_CURRENCY_CHAR_CODE,
     PATTERN_REPLY_SHOW_ALL_CURRENCIES,
     PATTERN_INLINE_SHOW_ALL_CURRENCIES,
+    INLINE_SHOW_ALL_CURRENCIES,
     CALLBACK_IGNORE,
-    fill_string_pattern,
 )
 from bot.third_party.auto_in_progress_message import (
     show_temp_message_decorator,
@@ -74,7 +84,8 @@ from bot.third_party.auto_in_progress_message import (
 )
 from bot.third_party import telegramcalendar
 
-from utils.graph import get_plot_for_currency
+from utils.graph import get_plot_for_currency, add_chart_request, chart_cache
+from utils.render_service import render_service
 
 
 FILTER_BY_ADMIN = Filters.user(username=USER_NAME_ADMINS)
@@ -93,6 +104,16 @@ FORMAT_CHECKBOX_EMPTY = "⬜ {}"
 
 COLUMNS_FOR_CURRENCY: int = 4
 
+# Клавиатуры зависят только от аргументов, поэтому построенные клавиатуры переиспользуются
+KEYBOARD_CACHE_SIZE: int = 1024
+
+# Ошибки Telegram, после которых сохраненный file_id графика больше не используется
+FILE_ID_ERRORS: tuple[str, ...] = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference expired",
+)
+
 
 def get_title_currency_by(
     currency_char_code: str,
@@ -110,16 +131,20 @@ def get_title_currency_by(
         return f"{prefix} последние {number} записей"
 
 
-def get_inline_keyboard_for_date_pagination(for_date: DT.date) -> InlineKeyboardMarkup:
-    pattern = PATTERN_INLINE_GET_BY_DATE
-    prev_date, next_date = db.ExchangeRate.get_prev_next_dates(for_date)
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _get_inline_keyboard_for_date_pagination(
+    for_date: DT.date,
+    prev_date: Optional[DT.date],
+    next_date: Optional[DT.date],
+) -> InlineKeyboardMarkup:
+    callback_format = FORMAT_INLINE_GET_BY_DATE
 
     buttons = []
     if prev_date:
         buttons.append(
             InlineKeyboardButton(
                 text=FORMAT_PREV.format(get_date_str(prev_date)),
-                callback_data=fill_string_pattern(pattern, prev_date),
+                callback_data=callback_format.format(prev_date),
             )
         )
 
@@ -127,7 +152,7 @@ def get_inline_keyboard_for_date_pagination(for_date: DT.date) -> InlineKeyboard
     buttons.append(
         InlineKeyboardButton(
             text=FORMAT_CURRENT.format(get_date_str(for_date)),
-            callback_data=fill_string_pattern(pattern, CALLBACK_IGNORE),
+            callback_data=callback_format.format(CALLBACK_IGNORE),
         )
     )
 
@@ -135,24 +160,37 @@ def get_inline_keyboard_for_date_pagination(for_date: DT.date) -> InlineKeyboard
         buttons.append(
             InlineKeyboardButton(
                 text=FORMAT_NEXT.format(get_date_str(next_date)),
-                callback_data=fill_string_pattern(pattern, next_date),
+                callback_data=callback_format.format(next_date),
             )
         )
 
-    return InlineKeyboardMarkup.from_row(buttons)
+    return FingerprintInlineKeyboardMarkup.from_row(buttons)
 
 
-def get_buttons_for_selected_currencies(
+def get_inline_keyboard_for_date_pagination(for_date: DT.date) -> InlineKeyboardMarkup:
+    prev_date, next_date = db.ExchangeRate.get_prev_next_dates(for_date)
+    return _get_inline_keyboard_for_date_pagination(for_date, prev_date, next_date)
+
+
+def get_selected_currencies(
     update: Update,
-    pattern: re.Pattern,
-    current_currency_char_code: str,
-    current_value: int,
     selected_currencies: list[str] = None,
-) -> list[list[InlineKeyboardButton]]:
+) -> tuple[str, ...]:
     if not selected_currencies:
         user_id = update.effective_user.id
         selected_currencies = db.Settings.get_selected_currencies(user_id)
 
+    # Кортеж, чтобы его можно было использовать в ключе кэша клавиатур
+    return tuple(selected_currencies)
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_buttons_for_selected_currencies(
+    callback_format: str,
+    current_currency_char_code: str,
+    current_value: int,
+    selected_currencies: tuple[str, ...],
+) -> tuple[tuple[InlineKeyboardButton, ...], ...]:
     buttons: list[list[InlineKeyboardButton]] = []
 
     for row in split_list(selected_currencies, columns=COLUMNS_FOR_CURRENCY):
@@ -163,69 +201,86 @@ def get_buttons_for_selected_currencies(
             buttons[-1].append(
                 InlineKeyboardButton(
                     text=FORMAT_CURRENT.format(currency_char_code) if is_current else currency_char_code,
-                    callback_data=fill_string_pattern(
-                        pattern,
+                    callback_data=callback_format.format(
                         CALLBACK_IGNORE if is_current else currency_char_code,
                         CALLBACK_IGNORE if is_current else current_value,
                     ),
                 )
             )
 
-    return buttons
+    # Результат общий для всех вызовов, поэтому возвращается неизменяемым
+    return tuple(tuple(row) for row in buttons)
 
 
-def get_inline_keyboard_for_number_pagination(
-    update: Update,
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _get_inline_keyboard_for_number_pagination(
     current_currency_char_code: str,
     current_number: int,
-    selected_currencies: list[str] = None,
+    selected_currencies: tuple[str, ...],
 ) -> InlineKeyboardMarkup:
-    buttons = get_buttons_for_selected_currencies(
-        update=update,
-        pattern=PATTERN_INLINE_GET_CHART_CURRENCY_BY_NUMBER,
-        current_currency_char_code=current_currency_char_code,
-        current_value=current_number,
-        selected_currencies=selected_currencies,
-    )
+    buttons = [
+        list(row)
+        for row in get_buttons_for_selected_currencies(
+            callback_format=FORMAT_INLINE_GET_CHART_CURRENCY_BY_NUMBER,
+            current_currency_char_code=current_currency_char_code,
+            current_value=current_number,
+            selected_currencies=selected_currencies,
+        )
+    ]
 
     buttons.append([
         InlineKeyboardButton(
             text="Посмотреть за определенный год",
-            callback_data=fill_string_pattern(
-                PATTERN_INLINE_GET_CHART_CURRENCY_BY_YEAR,
+            callback_data=FORMAT_INLINE_GET_CHART_CURRENCY_BY_YEAR.format(
                 current_currency_char_code,
                 -1,
             ),
         )
     ])
 
-    return InlineKeyboardMarkup(buttons)
+    return FingerprintInlineKeyboardMarkup(buttons)
 
 
-def get_inline_keyboard_for_year_pagination(
-        update: Update,
-        current_currency_char_code: str,
-        current_year: int,
+def get_inline_keyboard_for_number_pagination(
+    update: Update,
+    current_currency_char_code: str,
+    current_number: int,
+    selected_currencies: list[str] = None,
 ) -> InlineKeyboardMarkup:
-    pattern = PATTERN_INLINE_GET_CHART_CURRENCY_BY_YEAR
-
-    buttons = get_buttons_for_selected_currencies(
-        update=update,
-        pattern=pattern,
-        current_currency_char_code=current_currency_char_code,
-        current_value=current_year,
+    return _get_inline_keyboard_for_number_pagination(
+        current_currency_char_code,
+        current_number,
+        get_selected_currencies(update, selected_currencies),
     )
 
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _get_inline_keyboard_for_year_pagination(
+    current_currency_char_code: str,
+    current_year: int,
+    selected_currencies: tuple[str, ...],
+    prev_year: Optional[int],
+    next_year: Optional[int],
+) -> InlineKeyboardMarkup:
+    callback_format = FORMAT_INLINE_GET_CHART_CURRENCY_BY_YEAR
+
+    buttons = [
+        list(row)
+        for row in get_buttons_for_selected_currencies(
+            callback_format=callback_format,
+            current_currency_char_code=current_currency_char_code,
+            current_value=current_year,
+            selected_currencies=selected_currencies,
+        )
+    ]
+
     buttons.append([])
-    prev_year, next_year = db.ExchangeRate.get_prev_next_years(
-        year=current_year, currency_char_code=current_currency_char_code
-    )
     if prev_year:
         buttons[-1].append(
             InlineKeyboardButton(
                 text=FORMAT_PREV.format(prev_year),
-                callback_data=fill_string_pattern(
-                    pattern, current_currency_char_code, prev_year
+                callback_data=callback_format.format(
+                    current_currency_char_code, prev_year
                 ),
             )
         )
@@ -234,8 +289,8 @@ def get_inline_keyboard_for_year_pagination(
     buttons[-1].append(
         InlineKeyboardButton(
             text=FORMAT_CURRENT.format(current_year),
-            callback_data=fill_string_pattern(
-                pattern, CALLBACK_IGNORE, CALLBACK_IGNORE
+            callback_data=callback_format.format(
+                CALLBACK_IGNORE, CALLBACK_IGNORE
             ),
         )
     )
@@ -244,20 +299,61 @@ def get_inline_keyboard_for_year_pagination(
         buttons[-1].append(
             InlineKeyboardButton(
                 text=FORMAT_NEXT.format(next_year),
-                callback_data=fill_string_pattern(
-                    pattern, current_currency_char_code, next_year
+                callback_data=callback_format.format(
+                    current_currency_char_code, next_year
                 ),
             )
         )
 
-    return InlineKeyboardMarkup(buttons)
+    return FingerprintInlineKeyboardMarkup(buttons)
+
+
+def get_inline_keyboard_for_year_pagination(
+        update: Update,
+        current_currency_char_code: str,
+        current_year: int,
+) -> InlineKeyboardMarkup:
+    prev_year, next_year = db.ExchangeRate.get_prev_next_years(
+        year=current_year, currency_char_code=current_currency_char_code
+    )
+    return _get_inline_keyboard_for_year_pagination(
+        current_currency_char_code,
+        current_year,
+        get_selected_currencies(update),
+        prev_year,
+        next_year,
+    )
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_inline_keyboard_for_settings(
+    currency_by_enabled: tuple[tuple[str, bool], ...],
+) -> InlineKeyboardMarkup:
+    # Генерация матрицы кнопок
+    items = [
+        InlineKeyboardButton(
+            (FORMAT_CHECKBOX if is_selected else FORMAT_CHECKBOX_EMPTY).format(currency),
+            callback_data=FORMAT_INLINE_SETTINGS_SELECT_CURRENCY_CHAR_CODE.format(currency),
+        )
+        for currency, is_selected in currency_by_enabled
+    ]
+    buttons = split_list(items, columns=COLUMNS_FOR_CURRENCY)
+
+    buttons.append([
+        InlineKeyboardButton(
+            text=SeverityEnum.INFO.get_text("Посмотреть справку по валютам"),
+            callback_data=INLINE_SHOW_ALL_CURRENCIES,
+        )
+    ])
+
+    return FingerprintInlineKeyboardMarkup(buttons)
 
 
 def get_reply_keyboard(update: Update) -> ReplyKeyboardMarkup:
     is_active = db.Subscription.has_is_active(update.effective_user.id)
 
     commands = [
-        [REPLY_COMMAND_LAST, fill_string_pattern(PATTERN_REPLY_SELECT_DATE)],
+        [REPLY_COMMAND_LAST, REPLY_SELECT_DATE],
         [REPLY_COMMAND_LAST_BY_WEEK, REPLY_COMMAND_LAST_BY_MONTH, REPLY_COMMAND_GET_ALL],
         [REPLY_COMMAND_UNSUBSCRIBE if is_active else REPLY_COMMAND_SUBSCRIBE],
     ]
@@ -277,32 +373,32 @@ def reply_or_edit_plot_with_keyboard(
     message = update.effective_message
     query = update.callback_query
 
-    photo = get_plot_for_currency(
-        currency_char_code=currency_char_code,
-        number=number,
-        year=year,
-    )
-
     # Для запросов CallbackQuery нужно менять текущее сообщение
     if query:
         # Fix error: "telegram.error.BadRequest: Message is not modified"
         if reply_markup and is_equal_inline_keyboards(reply_markup, query.message.reply_markup):
             return
 
-        try:
-            message.edit_media(
-                media=InputMediaPhoto(media=photo, caption=title),
-                reply_markup=reply_markup,
-                **kwargs,
-            )
-        except BadRequest as e:
-            if "Message is not modified" in str(e):
-                return
+    # Популярные графики будут заранее отрисованы после появления новых курсов
+    add_chart_request(currency_char_code, number, year)
 
-            raise e
+    def send(photo: Union[str, BytesIO]) -> Optional[Message]:
+        if query:
+            try:
+                result = message.edit_media(
+                    media=InputMediaPhoto(media=photo, caption=title),
+                    reply_markup=reply_markup,
+                    **kwargs,
+                )
+                return result if isinstance(result, Message) else None
 
-    else:
-        message.reply_photo(
+            except BadRequest as e:
+                if "Message is not modified" in str(e):
+                    return
+
+                raise e
+
+        return message.reply_photo(
             photo=photo,
             caption=title,
             reply_markup=reply_markup,
@@ -310,6 +406,34 @@ def reply_or_edit_plot_with_keyboard(
             **kwargs,
         )
 
+    # Если такой график уже загружался, то его можно отправить по file_id
+    last_date = db.ExchangeRate.get_last_date()
+    file_id = db.ChartFile.get_file_id(currency_char_code, number, year, last_date)
+    if file_id:
+        try:
+            send(file_id)
+            return
+
+        except BadRequest as e:
+            if not any(text in str(e).lower() for text in FILE_ID_ERRORS):
+                raise e
+
+            log.warning(f"Telegram не принял file_id {file_id!r}, график будет загружен заново: {e}")
+            db.ChartFile.remove_file_id(file_id)
+
+    photo = get_plot_for_currency(
+        currency_char_code=currency_char_code,
+        number=number,
+        year=year,
+    )
+
+    result = send(photo)
+    if result and result.photo:
+        # Самый большой размер, остальные Telegram получает из него
+        db.ChartFile.set_file_id(
+            currency_char_code, number, year, last_date, result.photo[-1].file_id
+        )
+
 
 @log_func(log)
 def on_start(update: Update, context: CallbackContext):
@@ -326,8 +450,6 @@ def on_start(update: Update, context: CallbackContext):
 def reply_settings_select_currency_char_code(update: Update, context: CallbackContext):
     message = update.effective_message
 
-    pattern = PATTERN_INLINE_SETTINGS_SELECT_CURRENCY_CHAR_CODE
-
     all_currency_char_codes = list(DEFAULT_CURRENCY_CHAR_CODES)
     for char_code in db.Currency.get_all_char_codes():
         if char_code not in all_currency_char_codes:
@@ -367,27 +489,10 @@ def reply_settings_select_currency_char_code(update: Update, context: CallbackCo
         ]
         db.Settings.set_selected_currencies(user_id, selected_currencies)
 
-    # Генерация матрицы кнопок
-    items = [
-        InlineKeyboardButton(
-            (FORMAT_CHECKBOX if is_selected else FORMAT_CHECKBOX_EMPTY).format(currency),
-            callback_data=fill_string_pattern(pattern, currency),
-        )
-        for currency, is_selected in currency_by_enabled.items()
-    ]
-    buttons = split_list(items, columns=COLUMNS_FOR_CURRENCY)
-
-    buttons.append([
-        InlineKeyboardButton(
-            text=SeverityEnum.INFO.get_text("Посмотреть справку по валютам"),
-            callback_data=fill_string_pattern(PATTERN_INLINE_SHOW_ALL_CURRENCIES),
-        )
-    ])
-
     reply_text_or_edit_with_keyboard(
         message=message, query=query,
         text="Выбор интересующих валют",
-        reply_markup=InlineKeyboardMarkup(buttons),
+        reply_markup=get_inline_keyboard_for_settings(tuple(currency_by_enabled.items())),
     )
 
 
@@ -410,13 +515,50 @@ def on_get_admin_stats(update: Update, context: CallbackContext):
 
     subscription_active_count = db.Subscription.select().where(db.Subscription.is_active == True).count()
 
+    chart_cache_stats = chart_cache.get_stats()
+    render_stats = render_service.get_stats()
+    write_stats = db.db.write_stats.get()
+    settings_cache_stats = db.settings_cache.get_stats()
+    subscription_cache_stats = db.subscription_cache.get_stats()
+
     reply_message(
         f"<b>Статистика админа</b>\n\n"
         f"<b>Курсы валют</b>\n"
         f"Количество: <b><u>{currency_count}</u></b>\n"
         f"Диапазон значений: <b><u>{first_date} - {last_date}</u></b>\n\n"
         f"<b>Подписки</b>\n"
-        f"Количество активных: <b><u>{subscription_active_count}</u></b>",
+        f"Количество активных: <b><u>{subscription_active_count}</u></b>\n\n"
+        f"<b>Кэш графиков</b>\n"
+        f"Графиков: <b><u>{chart_cache_stats['items']}</u></b> "
+        f"({chart_cache_stats['size'] // 1024} КБ)\n"
+        f"Попаданий: <b><u>{chart_cache_stats['hits']}</u></b>, "
+        f"с диска: <b><u>{chart_cache_stats['disk_hits']}</u></b>, "
+        f"промахов: <b><u>{chart_cache_stats['misses']}</u></b>\n"
+        f"Вытеснений: <b><u>{chart_cache_stats['evictions']}</u></b>, "
+        f"сбросов: <b><u>{chart_cache_stats['invalidations']}</u></b>\n\n"
+        f"<b>Отрисовка графиков</b>\n"
+        f"Процессов: <b><u>{render_stats['processes']}</u></b>, "
+        f"в работе: <b><u>{render_stats['in_progress']}</u></b>\n"
+        f"Отрисовано: <b><u>{render_stats['completed']}</u></b>, "
+        f"отклонено: <b><u>{render_stats['rejected']}</u></b>, "
+        f"таймаутов: <b><u>{render_stats['timeouts']}</u></b>, "
+        f"ошибок: <b><u>{render_stats['errors']}</u></b>\n\n"
+        f"<b>Очередь записи в базу</b>\n"
+        f"Сейчас: <b><u>{db.db.get_queue_size()}</u></b>, "
+        f"максимум: <b><u>{write_stats['max_queue_size']}</u></b> из {db.db.queue_max_size}, "
+        f"переполнений: <b><u>{write_stats['queue_full']}</u></b>\n"
+        f"Запросов: <b><u>{write_stats['number']}</u></b>, "
+        f"ошибок: <b><u>{write_stats['errors']}</u></b>, "
+        f"таймаутов: <b><u>{write_stats['timeouts']}</u></b>\n"
+        f"Задержка: средняя <b><u>{write_stats['avg_latency'] * 1000:.1f}</u></b> мс, "
+        f"максимальная <b><u>{write_stats['max_latency'] * 1000:.1f}</u></b> мс\n\n"
+        f"<b>Кэш пользователей</b>\n"
+        f"Настройки: <b><u>{settings_cache_stats['items']}</u></b>, "
+        f"попаданий <b><u>{settings_cache_stats['hit_rate']:.0%}</u></b> "
+        f"({settings_cache_stats['hits']} из {settings_cache_stats['hits'] + settings_cache_stats['misses']})\n"
+        f"Подписки: <b><u>{subscription_cache_stats['items']}</u></b>, "
+        f"попаданий <b><u>{subscription_cache_stats['hit_rate']:.0%}</u></b> "
+        f"({subscription_cache_stats['hits']} из {subscription_cache_stats['hits'] + subscription_cache_stats['misses']})",
         update=update, context=context,
         parse_mode=ParseMode.HTML,
         severity=SeverityEnum.INFO,
@@ -685,6 +827,61 @@ def on_command_unsubscribe(update: Update, context: CallbackContext):
     )
 
 
+@log_func(log)
+def on_command_threshold(update: Update, context: CallbackContext):
+    message = update.effective_message
+    user_id = message.from_user.id
+
+    subscription = db.Subscription.get_by_user_id(user_id)
+    if not subscription or not subscription.is_active:
+        reply_message(
+            text="Подписка не оформлена 🤔!",
+            update=update, context=context,
+            severity=SeverityEnum.INFO,
+            reply_markup=get_reply_keyboard(update),
+        )
+        return
+
+    usage = (
+        f"Чтобы получать рассылку только при изменении курса выбранной валюты "
+        f"хотя бы на N процентов, отправьте /{COMMAND_THRESHOLD} N, например /{COMMAND_THRESHOLD} 0.5. "
+        f"Для рассылки при любом изменении: /{COMMAND_THRESHOLD} 0"
+    )
+
+    if not context.args:
+        if subscription.min_change_percent:
+            text = f"Рассылка при изменении курса от {subscription.min_change_percent:g}%.\n{usage}"
+        else:
+            text = f"Рассылка при любом изменении курса.\n{usage}"
+
+    else:
+        try:
+            value = float(context.args[0].replace(",", ".").rstrip("%"))
+            if not 0 <= value < 100:
+                raise ValueError()
+
+        except ValueError:
+            reply_message(
+                text=f"Неверное значение {context.args[0]!r}.\n{usage}",
+                update=update, context=context,
+                severity=SeverityEnum.ERROR,
+            )
+            return
+
+        subscription.set_min_change_percent(value or None)
+        if value:
+            text = f"Рассылка будет при изменении курса от {value:g}% 😉"
+        else:
+            text = "Рассылка будет при любом изменении курса 😉"
+
+    reply_message(
+        text=text,
+        update=update, context=context,
+        severity=SeverityEnum.INFO,
+        reply_markup=get_reply_keyboard(update),
+    )
+
+
 @log_func(log)
 def on_request(update: Update, context: CallbackContext):
     reply_message(
@@ -782,6 +979,8 @@ def setup(dp: Dispatcher):
         )
     )
 
+    dp.add_handler(CommandHandler(COMMAND_THRESHOLD, on_command_threshold))
+
     dp.add_handler(MessageHandler(Filters.text, on_request))
 
     dp.add_error_handler(on_error)
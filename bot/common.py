@@ -9,15 +9,22 @@ import functools
 import json
 import logging
 
-from typing import Union, Optional
-
-from telegram import Update, ReplyMarkup, InlineKeyboardMarkup, CallbackQuery, Message
+from typing import Any, Union, Optional
+
+from telegram import (
+    Update,
+    ReplyMarkup,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+    CallbackQuery,
+    Message,
+)
 from telegram.error import NetworkError, BadRequest
 from telegram.ext import CallbackContext
 from telegram.utils.types import FileInput
 from telegram.files.photosize import PhotoSize
 
-from root_common import get_logger
+from root_common import get_logger, SubscriptionResultEnum
 from root_config import DIR_LOGS, ERROR_TEXT, MAX_MESSAGE_LENGTH
 
 
@@ -74,13 +81,6 @@ class SeverityEnum(enum.Enum):
         return self.value.format(text=text)
 
 
-# SOURCE: https://github.com/gil9red/get_metal_rates/blob/6483005419c6abde470763af0b750159c1cc1290/root_common.py#L53
-class SubscriptionResultEnum(enum.Enum):
-    SUBSCRIBE_OK = enum.auto()
-    UNSUBSCRIBE_OK = enum.auto()
-    ALREADY = enum.auto()
-
-
 def reply_message(
     text: str,
     update: Update,
@@ -116,20 +116,60 @@ def reply_message(
             )
 
 
+def get_inline_keyboard_fingerprint(keyboard: InlineKeyboardMarkup) -> int:
+    """
+    Отпечаток содержимого клавиатуры. У FingerprintInlineKeyboardMarkup он уже посчитан
+    при создании, а для остальных клавиатур, например пришедших от Telegram, считается по кнопкам.
+    Отпечатки можно сравнивать только в пределах одного процесса
+    """
+
+    fingerprint = getattr(keyboard, "_fingerprint", None)
+    if fingerprint is not None:
+        return fingerprint
+
+    return hash(tuple(
+        tuple(
+            (
+                button.text,
+                button.callback_data,
+                button.url,
+                button.switch_inline_query,
+                button.switch_inline_query_current_chat,
+            )
+            for button in row
+        )
+        for row in keyboard.inline_keyboard
+    ))
+
+
+class FingerprintInlineKeyboardMarkup(InlineKeyboardMarkup):
+    """
+    Клавиатура с отпечатком содержимого, который считается один раз при создании.
+    После создания клавиатуру нельзя менять
+    """
+
+    # Атрибуты с "_" не попадают в to_dict, т.е. не отправляются в Telegram
+    __slots__ = ("_fingerprint",)
+
+    def __init__(self, inline_keyboard: list[list[InlineKeyboardButton]], **kwargs: Any):
+        super().__init__(inline_keyboard, **kwargs)
+        self._fingerprint: int = get_inline_keyboard_fingerprint(self)
+
+
 # SOURCE: https://github.com/gil9red/get_metal_rates/blob/1f43cf779cd34753654cbc2681a408352fa37709/app_tg_bot/bot/common.py#L234
 def is_equal_inline_keyboards(
         keyboard_1: Union[InlineKeyboardMarkup, str],
-        keyboard_2: InlineKeyboardMarkup
+        keyboard_2: Optional[InlineKeyboardMarkup],
 ) -> bool:
-    if isinstance(keyboard_1, InlineKeyboardMarkup):
-        keyboard_1_inline_keyboard = keyboard_1.to_dict()["inline_keyboard"]
-    elif isinstance(keyboard_1, str):
-        keyboard_1_inline_keyboard = json.loads(keyboard_1)["inline_keyboard"]
-    else:
+    if isinstance(keyboard_1, str):
+        keyboard_1 = InlineKeyboardMarkup.de_json(json.loads(keyboard_1), bot=None)
+    elif not isinstance(keyboard_1, InlineKeyboardMarkup):
         raise Exception(f"Unsupported format (keyboard_1={type(keyboard_1)})!")
 
-    keyboard_2_inline_keyboard = keyboard_2.to_dict()["inline_keyboard"]
-    return keyboard_1_inline_keyboard == keyboard_2_inline_keyboard
+    if not isinstance(keyboard_2, InlineKeyboardMarkup):
+        return False
+
+    return get_inline_keyboard_fingerprint(keyboard_1) == get_inline_keyboard_fingerprint(keyboard_2)
 
 
 # SOURCE: https://github.com/gil9red/telegram__random_bashim_bot/blob/e9c98248f10c4a74f0e26dcf5a949bf2260f57d4/common.py#L177
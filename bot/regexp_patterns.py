@@ -7,7 +7,7 @@ __author__ = "ipetrash"
 import datetime as DT
 import re
 
-from bot.third_party.regexp import fill_string_pattern
+from bot.third_party.regexp import fill_string_pattern, get_string_format
 
 
 COMMAND_ADMIN_STATS = "admin_stats"
@@ -18,23 +18,32 @@ PATTERN_REPLY_ADMIN_STATS = re.compile(
 COMMAND_SETTINGS = "settings"
 PATTERN_REPLY_SETTINGS = re.compile(r"^Настройки$|^Settings$", flags=re.IGNORECASE)
 
+COMMAND_THRESHOLD = "threshold"
+
 PATTERN_REPLY_COMMAND_LAST = re.compile(r"^Последнее значение$", flags=re.IGNORECASE)
 REPLY_COMMAND_LAST = fill_string_pattern(PATTERN_REPLY_COMMAND_LAST)
 PATTERN_INLINE_GET_BY_DATE = re.compile(r"^get_by_date=(.+)$")
+FORMAT_INLINE_GET_BY_DATE = get_string_format(PATTERN_INLINE_GET_BY_DATE)
 
 PATTERN_REPLY_SELECT_DATE = re.compile(r"^Выбрать дату$", flags=re.IGNORECASE)
+REPLY_SELECT_DATE = fill_string_pattern(PATTERN_REPLY_SELECT_DATE)
 PATTERN_INLINE_SELECT_DATE = re.compile(r".+;\d+;\d+;\d+")  # NOTE: Формат telegramcalendar.py
 
 PATTERN_INLINE_GET_CHART_CURRENCY_BY_YEAR = re.compile(
     r"^get_chart currency=(.+) year=(.+)$"
 )
+FORMAT_INLINE_GET_CHART_CURRENCY_BY_YEAR = get_string_format(PATTERN_INLINE_GET_CHART_CURRENCY_BY_YEAR)
 
 PATTERN_INLINE_SETTINGS_SELECT_CURRENCY_CHAR_CODE = re.compile(
     r"^settings_select_currency_char_code=(.+)$"
 )
+FORMAT_INLINE_SETTINGS_SELECT_CURRENCY_CHAR_CODE = get_string_format(
+    PATTERN_INLINE_SETTINGS_SELECT_CURRENCY_CHAR_CODE
+)
 
 PATTERN_REPLY_SHOW_ALL_CURRENCIES = re.compile(r"^Все валюты$", flags=re.IGNORECASE)
 PATTERN_INLINE_SHOW_ALL_CURRENCIES = re.compile(r"^show_all_currencies$")
+INLINE_SHOW_ALL_CURRENCIES = fill_string_pattern(PATTERN_INLINE_SHOW_ALL_CURRENCIES)
 
 CALLBACK_IGNORE = "IGNORE"
 
@@ -50,6 +59,7 @@ REPLY_COMMAND_GET_ALL = "За всё время"
 PATTERN_INLINE_GET_CHART_CURRENCY_BY_NUMBER = re.compile(
     r"^get_chart currency=(.+) number=(.+)$"
 )
+FORMAT_INLINE_GET_CHART_CURRENCY_BY_NUMBER = get_string_format(PATTERN_INLINE_GET_CHART_CURRENCY_BY_NUMBER)
 
 PATTERN_REPLY_COMMAND_SUBSCRIBE = re.compile(r"^Подписаться$", flags=re.IGNORECASE)
 REPLY_COMMAND_SUBSCRIBE = fill_string_pattern(PATTERN_REPLY_COMMAND_SUBSCRIBE)
@@ -73,3 +83,17 @@ if __name__ == "__main__":
     )
 
     assert REPLY_COMMAND_LAST == "Последнее значение"
+
+    # Шаблоны дают те же строки, что и fill_string_pattern
+    assert FORMAT_INLINE_GET_BY_DATE.format(DT.date(2022, 4, 1)) == "get_by_date=2022-04-01"
+    assert (
+        FORMAT_INLINE_GET_CHART_CURRENCY_BY_NUMBER.format("USD", 7)
+        == fill_string_pattern(PATTERN_INLINE_GET_CHART_CURRENCY_BY_NUMBER, "USD", 7)
+    )
+    assert PATTERN_INLINE_GET_CHART_CURRENCY_BY_YEAR.match(
+        FORMAT_INLINE_GET_CHART_CURRENCY_BY_YEAR.format("USD", 2022)
+    )
+    assert PATTERN_INLINE_SETTINGS_SELECT_CURRENCY_CHAR_CODE.match(
+        FORMAT_INLINE_SETTINGS_SELECT_CURRENCY_CHAR_CODE.format("USD")
+    )
+    assert PATTERN_INLINE_SHOW_ALL_CURRENCIES.match(INLINE_SHOW_ALL_CURRENCIES)
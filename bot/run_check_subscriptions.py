@@ -5,66 +5,130 @@ __author__ = "ipetrash"
 
 
 import time
+from dataclasses import dataclass
 
 from telegram import Bot, ParseMode
 from telegram.error import BadRequest
+from telegram.utils.request import Request
 
 import db
+from bot.broadcast import WORKERS, Broadcaster
 from root_common import caller_name, get_logger
-from root_config import DIR_LOGS, TOKEN
+from root_config import DIR_LOGS, get_token
 
 
 log = get_logger(__file__, DIR_LOGS / "notifications.txt")
 
+SAFETY_POLL_TIMEOUT_SECS: int = 15 * 60
+
+
+def get_notification_text(selected_currencies: list[str]) -> str:
+    return f"<b>Рассылка</b>\n{db.ExchangeRate.get_full_description(selected_currencies)}"
+
+
+@dataclass
+class BroadcastPlan:
+    """
+    План рассылки: текст для каждой подписки.
+    Текст строится один раз для каждого уникального набора валют
+    """
+
+    items: list[tuple[db.Subscription, str]]
+    renders: int
+
+    @property
+    def saved_renders(self) -> int:
+        return len(self.items) - self.renders
+
+    @classmethod
+    def create(cls, subscriptions: list[db.Subscription]) -> "BroadcastPlan":
+        selected_currencies_by_user_id = db.Settings.get_selected_currencies_by_user_ids(
+            [subscription.user_id for subscription in subscriptions]
+        )
+
+        text_by_currencies: dict[tuple[str, ...], str] = dict()
+        items = []
+        for subscription in subscriptions:
+            selected_currencies = tuple(
+                selected_currencies_by_user_id[subscription.user_id]
+            )
+
+            text = text_by_currencies.get(selected_currencies)
+            if text is None:
+                text = get_notification_text(list(selected_currencies))
+                text_by_currencies[selected_currencies] = text
+
+            items.append((subscription, text))
+
+        return cls(items=items, renders=len(text_by_currencies))
+
+
+def send_notifications(bot: Bot, subscriptions: list[db.Subscription], prefix: str):
+    log.info(
+        f"{prefix} Выполняется рассылка к {len(subscriptions)} пользователям"
+    )
+
+    plan = BroadcastPlan.create(subscriptions)
+    log.info(
+        f"{prefix} Подготовлено текстов: {plan.renders}, "
+        f"сэкономлено построений: {plan.saved_renders}"
+    )
+
+    def send(item: tuple[db.Subscription, str]):
+        subscription, text = item
+
+        try:
+            broadcaster.send_message(
+                chat_id=subscription.user_id,  # Для приватных чатов chat_id равен user_id
+                text=text,
+                parse_mode=ParseMode.HTML,
+            )
+
+            # Отметка сохраняется сразу, чтобы после перезапуска рассылка продолжилась
+            subscription.was_sending = True
+            subscription.save()
+
+        except BadRequest as e:
+            if "Chat not found" in str(e):
+                log.info(f"Рассылка невозможна: пользователь #{subscription.user_id} не найден")
+                subscription.is_active = False
+                subscription.save()
+            else:
+                raise e
+
+    broadcaster = Broadcaster(bot, log=log)
+    sent_count = broadcaster.run(send, plan.items)
+    log.info(f"{prefix} Рассылка завершена, обработано {sent_count} из {len(plan.items)}")
+
 
 def sending_notifications():
     prefix = f"[{caller_name()}]"
 
-    bot = Bot(TOKEN)
+    # По соединению на каждый поток рассылки и одно для основного потока,
+    # иначе потоки будут ждать свободное соединение в пуле
+    bot = Bot(get_token(), request=Request(con_pool_size=WORKERS + 1))
 
     log.info(f"{prefix} Запуск")
     log.debug(f"{prefix} Имя бота {bot.first_name!r} ({bot.name})")
 
+    # Номер запоминается до проверки подписок, чтобы не пропустить событие во время рассылки
+    event_number = db.new_rates_event.number
+
     while True:
         try:
-            subscriptions = db.Subscription.get_active_unsent_subscriptions()
-            if not subscriptions:
-                continue
-
-            log.info(
-                f"{prefix} Выполняется рассылка к {len(subscriptions)} пользователям"
-            )
-
-            for subscription in subscriptions:
-                selected_currencies = db.Settings.get_selected_currencies(
-                    subscription.user_id
-                )
-                text = f"<b>Рассылка</b>\n{db.ExchangeRate.get_full_description(selected_currencies)}"
-
-                try:
-                    bot.send_message(
-                        chat_id=subscription.user_id,  # Для приватных чатов chat_id равен user_id
-                        text=text,
-                        parse_mode=ParseMode.HTML,
-                    )
-                    subscription.was_sending = True
-                    subscription.save()
-
-                except BadRequest as e:
-                    if "Chat not found" in str(e):
-                        log.info(f"Рассылка невозможна: пользователь #{subscription.user_id} не найден")
-                        subscription.is_active = False
-                        subscription.save()
-                    else:
-                        raise e
-
-                time.sleep(0.4)
+            subscriptions = list(db.Subscription.get_active_unsent_subscriptions())
+            if subscriptions:
+                send_notifications(bot, subscriptions, prefix)
 
         except Exception:
             log.exception(f"{prefix} Ошибка:")
             time.sleep(60)
+            continue
 
-        finally:
-            time.sleep(1)
+        # Ожидание новых курсов от парсера. Периодическая проверка нужна на случай,
+        # если подписки для рассылки появились в обход события
+        event_number = db.new_rates_event.wait(
+            event_number, timeout=SAFETY_POLL_TIMEOUT_SECS
+        )
 
     log.info(f"{prefix} Завершение")
@@ -7,7 +7,11 @@ __author__ = 'ipetrash'
 import re
 
 
-def fill_string_pattern(pattern: re.Pattern, *args) -> str:
+def get_string_format(pattern: re.Pattern) -> str:
     pattern = pattern.pattern
     pattern = pattern.strip('^$')
-    return re.sub(r'\(.+?\)', '{}', pattern).format(*args)
+    return re.sub(r'\(.+?\)', '{}', pattern)
+
+
+def fill_string_pattern(pattern: re.Pattern, *args) -> str:
+    return get_string_format(pattern).format(*args)
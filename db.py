@@ -4,9 +4,12 @@
 __author__ = "ipetrash"
 
 
+import bisect
 import datetime as DT
 import enum
+import threading
 import time
+from concurrent.futures import Future
 from decimal import Decimal
 from typing import Type, Iterable, Optional, Union
 
@@ -22,17 +25,45 @@ from peewee import (
     CharField,
     IntegerField,
     DateTimeField,
+    FloatField,
+    Query,
+    chunked,
+    SENTINEL,
+    EXCLUDED,
+    Case,
+    fn,
 )
-from playhouse.sqliteq import SqliteQueueDatabase
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.sqliteq import SqliteQueueDatabase, AsyncCursor, ResultTimeout
 
 from root_config import DB_FILE_NAME, DEFAULT_CURRENCY_CHAR_CODES
-from bot.common import SubscriptionResultEnum
-from root_common import get_start_date, get_end_date, get_date_str
+from root_common import (
+    get_start_date,
+    get_end_date,
+    get_date_str,
+    SubscriptionResultEnum,
+    LruTtlCache,
+)
 from parser.config import START_DATE
 
 
 ITEMS_PER_PAGE: int = 10
 
+# Ограничение на количество строк в одном INSERT, чтобы не упереться в лимит параметров SQLite
+INSERT_BATCH_SIZE: int = 300
+
+# Кэш настроек и подписок пользователей
+USER_CACHE_MAX_SIZE: int = 10_000
+USER_CACHE_TTL_SECS: float = 15 * 60
+
+# Очередь запросов на запись: при переполнении запись блокируется, а ожидание
+# результата через rowcount/lastrowid прерывается ResultTimeout по истечении DB_RESULTS_TIMEOUT
+DB_QUEUE_MAX_SIZE: int = 64
+DB_RESULTS_TIMEOUT: float = 5.0
+
+# Ожидание future записи, например, при добавлении курсов пачками
+DB_WRITE_TIMEOUT: float = 60.0
+
 
 def shorten(text: str, length=30) -> str:
     if not text:
@@ -43,9 +74,143 @@ def shorten(text: str, length=30) -> str:
     return text
 
 
+class WriteStats:
+    """
+    Метрики очереди записи: размер очереди, задержка от постановки запроса
+    в очередь до его выполнения, переполнения очереди и таймауты ожидания
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        self.number: int = 0
+        self.errors: int = 0
+        self.timeouts: int = 0
+        self.queue_full: int = 0
+        self.max_queue_size: int = 0
+
+        self.total_latency: float = 0.0
+        self.max_latency: float = 0.0
+
+    def add_queued(self, queue_size: int):
+        with self._lock:
+            self.max_queue_size = max(self.max_queue_size, queue_size)
+
+    def add_queue_full(self):
+        with self._lock:
+            self.queue_full += 1
+
+    def add_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def add_done(self, latency: float, is_error: bool):
+        with self._lock:
+            self.number += 1
+            if is_error:
+                self.errors += 1
+
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def get(self) -> dict[str, Union[int, float]]:
+        with self._lock:
+            return dict(
+                number=self.number,
+                errors=self.errors,
+                timeouts=self.timeouts,
+                queue_full=self.queue_full,
+                max_queue_size=self.max_queue_size,
+                avg_latency=self.total_latency / self.number if self.number else 0.0,
+                max_latency=self.max_latency,
+            )
+
+
+class WriteCursor(AsyncCursor):
+    """
+    Запрос на запись в очереди. Кроме ожидания через rowcount/lastrowid,
+    у запроса есть future, которое завершается после выполнения запроса
+    и возвращает количество измененных строк
+    """
+
+    __slots__ = ("future", "_stats", "_queued_at")
+
+    def __init__(self, stats: WriteStats, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.future: Future = Future()
+        self._stats = stats
+        self._queued_at = time.monotonic()
+
+    def set_result(self, cursor, exc: Exception = None):
+        self._stats.add_done(time.monotonic() - self._queued_at, is_error=exc is not None)
+
+        result = super().set_result(cursor, exc)
+        if exc is None:
+            self.future.set_result(cursor.rowcount)
+        else:
+            self.future.set_exception(exc)
+
+        return result
+
+    def _wait(self, timeout: float = None):
+        try:
+            super()._wait(timeout)
+        except ResultTimeout as e:
+            self._stats.add_timeout()
+            raise e
+
+
+class QueueDatabase(SqliteQueueDatabase):
+    """
+    SqliteQueueDatabase с явным ожиданием записи: submit возвращает future запроса,
+    а flush ждет выполнения всех запросов, поставленных в очередь до его вызова
+    """
+
+    def __init__(self, *args, queue_max_size: int = None, **kwargs):
+        super().__init__(*args, queue_max_size=queue_max_size, **kwargs)
+
+        self.queue_max_size = queue_max_size
+        self.write_stats = WriteStats()
+
+    def execute_sql(self, sql: str, params=None, commit=SENTINEL, timeout: float = None):
+        if commit is SENTINEL:
+            commit = not sql.lower().startswith("select")
+
+        if not commit:
+            return self._execute(sql, params, commit=commit)
+
+        cursor = WriteCursor(
+            self.write_stats,
+            event=self._thread_helper.event(),
+            sql=sql,
+            params=params,
+            commit=commit,
+            timeout=self._results_timeout if timeout is None else timeout,
+        )
+
+        # Очередь заполнена, и put будет ждать, пока поток записи ее не разгрузит
+        if self.queue_max_size and self._write_queue.qsize() >= self.queue_max_size:
+            self.write_stats.add_queue_full()
+
+        self._write_queue.put(cursor)
+        self.write_stats.add_queued(self._write_queue.qsize())
+        return cursor
+
+    def submit(self, query: Query) -> Future:
+        return self.execute(query).future
+
+    def flush(self, timeout: float = DB_WRITE_TIMEOUT):
+        # Очередь выполняется по порядку, поэтому после этого запроса выполнены и все предыдущие
+        self.execute_sql("PRAGMA user_version", commit=True).future.result(timeout)
+
+    def get_queue_size(self) -> int:
+        return self._write_queue.qsize()
+
+
 # This working with multithreading
 # SOURCE: http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#sqliteq
-db = SqliteQueueDatabase(
+db = QueueDatabase(
     DB_FILE_NAME,
     pragmas={
         "foreign_keys": 1,
@@ -54,8 +219,8 @@ db = SqliteQueueDatabase(
     },
     use_gevent=False,     # Use the standard library "threading" module.
     autostart=True,
-    queue_max_size=64,    # Max. # of pending writes that can accumulate.
-    results_timeout=5.0,  # Max. time to wait for query to be executed.
+    queue_max_size=DB_QUEUE_MAX_SIZE,    # Max. # of pending writes that can accumulate.
+    results_timeout=DB_RESULTS_TIMEOUT,  # Max. time to wait for query to be executed.
 )
 
 
@@ -105,6 +270,22 @@ class BaseModel(Model):
     def count(cls) -> int:
         return cls.select().count()
 
+    @classmethod
+    def insert_many_ignore(cls, rows: Iterable[tuple], fields: list[Field]) -> int:
+        """
+        Добавление строк пачками через INSERT OR IGNORE, уже существующие строки пропускаются.
+        Возвращает количество добавленных строк
+        """
+
+        # Все пачки ставятся в очередь сразу, а результат ожидается в конце
+        futures = [
+            cls._meta.database.submit(
+                cls.insert_many(batch, fields=fields).on_conflict_ignore()
+            )
+            for batch in chunked(rows, INSERT_BATCH_SIZE)
+        ]
+        return sum(future.result(timeout=DB_WRITE_TIMEOUT) for future in futures)
+
     @classmethod
     def print_count_of_tables(cls):
         items = []
@@ -147,13 +328,21 @@ class ExchangeRate(BaseModel):
             (("date", "currency_code"), True),
         )
 
+    @classmethod
+    def refresh_cache(cls) -> int:
+        return rates_cache.refresh()
+
+    @classmethod
+    def clear_cache(cls):
+        rates_cache.clear()
+
     @classmethod
     def get_by(cls, date: DT.date, currency_char_code: str) -> Optional["ExchangeRate"]:
-        return cls.get_or_none(date=date, currency_code=currency_char_code)
+        return rates_cache.get_by(date, currency_char_code)
 
     @classmethod
     def has_date(cls, date: DT.date) -> bool:
-        return bool(cls.get_or_none(date=date))
+        return rates_cache.has_date(date)
 
     @classmethod
     def add(
@@ -162,7 +351,8 @@ class ExchangeRate(BaseModel):
         currency_char_code: str,
         value: Decimal,
     ) -> "ExchangeRate":
-        obj = cls.get_by(date=date, currency_char_code=currency_char_code)
+        # Проверка идет по базе, т.к. кэш обновляется только после завершения добавления
+        obj = cls.get_or_none(date=date, currency_code=currency_char_code)
         if not obj:
             obj = cls.create(
                 date=date,
@@ -172,10 +362,41 @@ class ExchangeRate(BaseModel):
 
         return obj
 
+    @classmethod
+    def add_many(cls, items: Iterable[tuple[DT.date, str, Decimal]]) -> int:
+        """
+        Добавление курсов валют (дата, код валюты, значение) пачкой.
+        Возвращает количество добавленных записей
+        """
+
+        return cls.insert_many_ignore(
+            items, fields=[cls.date, cls.currency_code, cls.value]
+        )
+
+    @classmethod
+    def upsert_many(cls, items: Iterable[tuple[DT.date, str, Decimal]]) -> int:
+        """
+        Добавление курсов валют (дата, код валюты, значение) пачкой, у существующих
+        записей значение исправляется, если отличается. Id записей при этом не меняются.
+        Возвращает количество добавленных и исправленных записей
+        """
+
+        futures = [
+            cls._meta.database.submit(
+                cls.insert_many(batch, fields=[cls.date, cls.currency_code, cls.value])
+                .on_conflict(
+                    conflict_target=[cls.date, cls.currency_code],
+                    update={cls.value: EXCLUDED.value},
+                    where=(cls.value != EXCLUDED.value),
+                )
+            )
+            for batch in chunked(items, INSERT_BATCH_SIZE)
+        ]
+        return sum(future.result(timeout=DB_WRITE_TIMEOUT) for future in futures)
+
     @classmethod
     def get_last_dates(cls, number: int = -1) -> list[DT.date]:
-        query = cls.select(cls.date).distinct().limit(number).order_by(cls.date.desc())
-        items = [rate.date for rate in query]
+        items = rates_cache.get_last_dates(number)
         if not items:
             items.append(START_DATE)
         return items
@@ -196,27 +417,20 @@ class ExchangeRate(BaseModel):
         cls, currency_char_code: str, number: int = -1
     ) -> list["ExchangeRate"]:
         dates = cls.get_last_dates(number)
-        query = (
-            cls.select()
-            .where(cls.currency_code == currency_char_code, cls.date.in_(dates))
-            .order_by(cls.date.asc())
+        return rates_cache.get_rates(
+            currency_char_code=currency_char_code,
+            start_date=dates[-1],
         )
-        return list(query)
 
     @classmethod
     def get_all_by_year(
         cls, currency_char_code: str, year: int
     ) -> list["ExchangeRate"]:
-        query = (
-            cls.select()
-            .where(
-                cls.currency_code == currency_char_code,
-                cls.date >= get_start_date(year),
-                cls.date <= get_end_date(year),
-            )
-            .order_by(cls.date.asc())
+        return rates_cache.get_rates(
+            currency_char_code=currency_char_code,
+            start_date=get_start_date(year),
+            end_date=get_end_date(year),
         )
-        return list(query)
 
     @classmethod
     def get_prev_next_dates(
@@ -224,91 +438,99 @@ class ExchangeRate(BaseModel):
         date: DT.date,
         currency_char_code: str = None,
     ) -> tuple[DT.date, DT.date]:
-        filters = [cls.date < date]
-        if currency_char_code:
-            filters.append(cls.currency_code == currency_char_code)
-        prev_val = (
-            cls.select(cls.date)
-            .distinct()
-            .where(*filters)
-            .limit(1)
-            .order_by(cls.date.desc())
-            .first()
-        )
-        prev_date = prev_val.date if prev_val else None
-
-        filters = [cls.date > date]
-        if currency_char_code:
-            filters.append(cls.currency_code == currency_char_code)
-        next_val = (
-            cls
-            .select(cls.date)
-            .distinct()
-            .where(*filters)
-            .limit(1)
-            .order_by(cls.date.asc())
-            .first()
-        )
-        next_date = next_val.date if next_val else None
-
-        return prev_date, next_date
+        return rates_cache.get_prev_next_dates(date, currency_char_code)
 
     @classmethod
     def get_prev_next_years(cls, year: int, currency_char_code: str = None) -> tuple[int, int]:
-        filters = [cls.date < get_start_date(year)]
-        if currency_char_code:
-            filters.append(cls.currency_code == currency_char_code)
-        prev_val = (
-            cls
-            .select(cls.date)
-            .distinct()
-            .where(*filters)
-            .limit(1)
-            .order_by(cls.date.desc())
-            .first()
+        prev_date, _ = rates_cache.get_prev_next_dates(
+            get_start_date(year), currency_char_code
         )
-        prev_year = prev_val.date.year if prev_val else None
-
-        filters = [cls.date > get_end_date(year)]
-        if currency_char_code:
-            filters.append(cls.currency_code == currency_char_code)
-        next_val = (
-            cls
-            .select(cls.date)
-            .distinct()
-            .where(*filters)
-            .limit(1)
-            .order_by(cls.date.asc())
-            .first()
+        prev_year = prev_date.year if prev_date else None
+
+        _, next_date = rates_cache.get_prev_next_dates(
+            get_end_date(year), currency_char_code
         )
-        next_year = next_val.date.year if next_val else None
+        next_year = next_date.year if next_date else None
 
         return prev_year, next_year
 
-    def get_description(self, show_diff: bool = True) -> str:
-        def get_diff_str(prev_amt: DecimalField, next_amt: DecimalField) -> str:
-            diff = next_amt - prev_amt
-            abs_diff = abs(diff)
+    @classmethod
+    def get_rates_with_prev(
+        cls,
+        date: DT.date,
+        currency_char_code_list: list[str],
+    ) -> dict[str, tuple["ExchangeRate", Optional["ExchangeRate"]]]:
+        """
+        Возвращает курсы валют за дату вместе с предыдущим значением каждой валюты
+        """
 
-            # Если разница целочисленная, то оставляем целым числом
-            if abs_diff % 1 == 0:
-                abs_diff = int(abs_diff)
+        items = dict()
+        for currency_char_code in currency_char_code_list:
+            rate = rates_cache.get_by(date, currency_char_code)
+            if not rate:
+                continue
 
-            sign = "-" if diff < 0 else "+"
-            return f"{sign}{abs_diff}"
+            prev_date, _ = rates_cache.get_prev_next_dates(date, currency_char_code)
+            prev_rate = rates_cache.get_by(prev_date, currency_char_code) if prev_date else None
 
-        prev_date, _ = self.get_prev_next_dates(
-            date=self.date, currency_char_code=self.currency_code
-        )
+            items[currency_char_code] = rate, prev_rate
+
+        return items
+
+    @classmethod
+    def get_changes(cls, date: DT.date) -> dict[str, float]:
+        """
+        Изменение курса каждой валюты за дату относительно предыдущей даты в процентах (по модулю).
+        Для валют без предыдущего курса возвращается inf
+        """
+
+        changes = dict()
+        for currency_char_code, (rate, prev_rate) in cls.get_rates_with_prev(
+            date, Currency.get_all_char_codes()
+        ).items():
+            if not prev_rate:
+                changes[currency_char_code] = float("inf")
+            elif not prev_rate.value:
+                changes[currency_char_code] = float("inf") if rate.value else 0.0
+            else:
+                changes[currency_char_code] = float(
+                    abs(rate.value - prev_rate.value) / prev_rate.value * 100
+                )
+
+        return changes
+
+    @staticmethod
+    def get_diff_str(prev_amt: Decimal, next_amt: Decimal) -> str:
+        diff = next_amt - prev_amt
+        abs_diff = abs(diff)
+
+        # Если разница целочисленная, то оставляем целым числом
+        if abs_diff % 1 == 0:
+            abs_diff = int(abs_diff)
+
+        sign = "-" if diff < 0 else "+"
+        return f"{sign}{abs_diff}"
+
+    def get_description_with(self, prev_rate: Optional["ExchangeRate"]) -> str:
         text_diff_value = ""
-        if prev_date and show_diff:
-            prev_rate = self.get_by(
-                date=prev_date, currency_char_code=self.currency_code
-            )
-            text_diff_value = f" ({get_diff_str(prev_rate.value, self.value)})"
+        if prev_rate:
+            text_diff_value = f" ({self.get_diff_str(prev_rate.value, self.value)})"
 
         return f"{self.currency_code}: {self.value}{text_diff_value}"
 
+    def get_description(self, show_diff: bool = True) -> str:
+        prev_rate = None
+        if show_diff:
+            prev_date, _ = self.get_prev_next_dates(
+                date=self.date, currency_char_code=self.currency_code
+            )
+            if prev_date:
+                prev_rate = self.get_by(
+                    date=prev_date, currency_char_code=self.currency_code
+                )
+
+        return self.get_description_with(prev_rate)
+
     @classmethod
     def get_full_description(
         cls,
@@ -319,11 +541,15 @@ class ExchangeRate(BaseModel):
         if not date:
             date = cls.get_last_date()
 
+        rate_with_prev_by_code = cls.get_rates_with_prev(date, currency_char_code_list)
+
         lines = [f"Актуальный курс за <b><u>{get_date_str(date)}</u></b>:"]
         for currency_char_code in currency_char_code_list:
-            rate = cls.get_by(date, currency_char_code)
-            if rate:
-                lines.append(f"    {rate.get_description(show_diff)}")
+            if currency_char_code not in rate_with_prev_by_code:
+                continue
+
+            rate, prev_rate = rate_with_prev_by_code[currency_char_code]
+            lines.append(f"    {rate.get_description_with(prev_rate if show_diff else None)}")
 
         return "\n".join(lines)
 
@@ -360,9 +586,19 @@ class Currency(BaseModel):
 
         return obj
 
+    @classmethod
+    def add_many(cls, items: Iterable[tuple[Union[int, str], str, str]]) -> int:
+        """
+        Добавление валют (числовой код, буквенный код, название) пачкой.
+        Возвращает количество добавленных валют
+        """
+
+        return cls.insert_many_ignore(items, fields=[cls.id, cls.char_code, cls.title])
+
     @classmethod
     def get_all_char_codes(cls) -> list[str]:
-        return [obj.char_code for obj in cls.select(cls.char_code)]
+        # Тот же порядок, что и у валют в SelectedCurrency, по нему строится сетка настроек
+        return [obj.char_code for obj in cls.select(cls.char_code).order_by(cls.char_code)]
 
     @classmethod
     def get_full_description(cls) -> str:
@@ -378,6 +614,237 @@ class Currency(BaseModel):
         )
 
 
+class RatesCache:
+    """
+    Кэш таблицы курсов валют в памяти процесса.
+    Данные в таблице меняются только парсером, поэтому после добавления записей
+    достаточно вызвать refresh, чтобы подгрузить новые строки
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+        # Меняется при подгрузке новых строк и при очистке кэша
+        self._version: int = 0
+
+        self._reset()
+
+    def _reset(self):
+        self._is_loaded = False
+        self._last_id: int = 0
+
+        # Отсортированный список всех дат и их множество
+        self._dates: list[DT.date] = []
+        self._date_set: set[DT.date] = set()
+
+        # Для каждой валюты отсортированные по дате колонки
+        self._dates_by_code: dict[str, list[DT.date]] = dict()
+        self._values_by_code: dict[str, list[Decimal]] = dict()
+        self._ids_by_code: dict[str, list[int]] = dict()
+
+    def _add_row(self, id: int, date: DT.date, currency_code: str, value: Decimal):
+        if date not in self._date_set:
+            self._date_set.add(date)
+            bisect.insort(self._dates, date)
+
+        dates = self._dates_by_code.setdefault(currency_code, [])
+        values = self._values_by_code.setdefault(currency_code, [])
+        ids = self._ids_by_code.setdefault(currency_code, [])
+
+        # Обычно записи добавляются в конец
+        i = len(dates)
+        if dates and date < dates[-1]:
+            i = bisect.bisect_left(dates, date)
+
+        dates.insert(i, date)
+        values.insert(i, value)
+        ids.insert(i, id)
+
+    def refresh(self) -> int:
+        """
+        Подгрузка в кэш новых строк таблицы. Возвращает количество добавленных записей
+        """
+
+        with self._lock:
+            query = (
+                ExchangeRate
+                .select(
+                    ExchangeRate.id,
+                    ExchangeRate.date,
+                    ExchangeRate.currency_code,
+                    ExchangeRate.value,
+                )
+                .where(ExchangeRate.id > self._last_id)
+                .order_by(ExchangeRate.id)
+                .tuples()
+            )
+
+            number = 0
+            for row in query:
+                self._add_row(*row)
+                self._last_id = row[0]
+                number += 1
+
+            if number:
+                self._version += 1
+
+            self._is_loaded = True
+            return number
+
+    def _ensure_loaded(self):
+        if not self._is_loaded:
+            self.refresh()
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+            self._version += 1
+
+    def get_version(self) -> int:
+        """
+        Номер версии данных: меняется после подгрузки новых строк и после очистки
+        """
+
+        with self._lock:
+            self._ensure_loaded()
+            return self._version
+
+    def get_columns(self, currency_char_code: str) -> tuple[int, list[DT.date], list[Decimal]]:
+        """
+        Версия данных и копии колонок дат и значений валюты
+        """
+
+        with self._lock:
+            self._ensure_loaded()
+            return (
+                self._version,
+                list(self._dates_by_code.get(currency_char_code, [])),
+                list(self._values_by_code.get(currency_char_code, [])),
+            )
+
+    def get_currency_char_codes(self) -> list[str]:
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._dates_by_code)
+
+    @staticmethod
+    def _create_rate(id: int, date: DT.date, currency_code: str, value: Decimal) -> ExchangeRate:
+        return ExchangeRate(id=id, date=date, currency_code=currency_code, value=value)
+
+    def get_by(self, date: DT.date, currency_char_code: str) -> Optional[ExchangeRate]:
+        with self._lock:
+            self._ensure_loaded()
+
+            dates = self._dates_by_code.get(currency_char_code)
+            if not dates:
+                return
+
+            i = bisect.bisect_left(dates, date)
+            if i == len(dates) or dates[i] != date:
+                return
+
+            return self._create_rate(
+                self._ids_by_code[currency_char_code][i],
+                date,
+                currency_char_code,
+                self._values_by_code[currency_char_code][i],
+            )
+
+    def has_date(self, date: DT.date) -> bool:
+        with self._lock:
+            self._ensure_loaded()
+            return date in self._date_set
+
+    def get_last_dates(self, number: int = -1) -> list[DT.date]:
+        with self._lock:
+            self._ensure_loaded()
+
+            dates = self._dates if number < 0 else self._dates[max(0, len(self._dates) - number):]
+            return dates[::-1]
+
+    def get_rates(
+        self,
+        currency_char_code: str,
+        start_date: DT.date = None,
+        end_date: DT.date = None,
+    ) -> list[ExchangeRate]:
+        with self._lock:
+            self._ensure_loaded()
+
+            dates = self._dates_by_code.get(currency_char_code)
+            if not dates:
+                return []
+
+            start = bisect.bisect_left(dates, start_date) if start_date else 0
+            end = bisect.bisect_right(dates, end_date) if end_date else len(dates)
+
+            ids = self._ids_by_code[currency_char_code]
+            values = self._values_by_code[currency_char_code]
+            return [
+                self._create_rate(ids[i], dates[i], currency_char_code, values[i])
+                for i in range(start, end)
+            ]
+
+    def get_prev_next_dates(
+        self,
+        date: DT.date,
+        currency_char_code: str = None,
+    ) -> tuple[Optional[DT.date], Optional[DT.date]]:
+        with self._lock:
+            self._ensure_loaded()
+
+            if currency_char_code:
+                dates = self._dates_by_code.get(currency_char_code, [])
+            else:
+                dates = self._dates
+
+            i = bisect.bisect_left(dates, date)
+            prev_date = dates[i - 1] if i > 0 else None
+
+            i = bisect.bisect_right(dates, date)
+            next_date = dates[i] if i < len(dates) else None
+
+            return prev_date, next_date
+
+
+rates_cache = RatesCache()
+
+
+class NewRatesEvent:
+    """
+    Событие о добавлении новых курсов валют.
+    Ожидающий поток передает номер последнего обработанного события,
+    поэтому событие, случившееся между ожиданиями, не теряется
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.number: int = 0
+
+    def notify(self):
+        with self._condition:
+            self.number += 1
+            self._condition.notify_all()
+
+    def wait(self, number: int, timeout: float = None) -> int:
+        """
+        Ожидание события с номером больше number. Возвращает номер последнего события
+        """
+
+        with self._condition:
+            self._condition.wait_for(lambda: self.number > number, timeout)
+            return self.number
+
+
+new_rates_event = NewRatesEvent()
+
+
+# Кэши с пользователями: id -> признак активной подписки, id -> отсортированный список валют.
+# Обновляются при сохранении Subscription и Settings
+subscription_cache = LruTtlCache(max_size=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL_SECS)
+settings_cache = LruTtlCache(max_size=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL_SECS)
+
+
 class Subscription(BaseModel):
     user_id = IntegerField(unique=True)
     is_active = BooleanField(default=True)
@@ -385,6 +852,15 @@ class Subscription(BaseModel):
     creation_datetime = DateTimeField(default=DT.datetime.now)
     modification_datetime = DateTimeField(default=DT.datetime.now)
 
+    # Рассылка только при изменении хотя бы одной из выбранных валют не меньше,
+    # чем на столько процентов. None - при любом изменении
+    min_change_percent = FloatField(null=True)
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        subscription_cache.set(self.user_id, self.is_active)
+        return result
+
     @classmethod
     def get_by_user_id(cls, user_id: int) -> Optional["Subscription"]:
         return cls.get_or_none(cls.user_id == user_id)
@@ -420,9 +896,60 @@ class Subscription(BaseModel):
     def get_active_unsent_subscriptions(cls) -> list["Subscription"]:
         return cls.select().where(cls.was_sending == False, cls.is_active == True)
 
+    @classmethod
+    def mark_unsent_by_changes(cls, changes: dict[str, float]) -> int:
+        """
+        Сброс признака рассылки у активных подписок, у которых среди выбранных валют есть
+        изменившиеся (см. ExchangeRate.get_changes) с учетом min_change_percent.
+        Возвращает количество таких подписок
+        """
+
+        changes = {char_code: change for char_code, change in changes.items() if change > 0}
+        if not changes:
+            return 0
+
+        min_change_percent = fn.COALESCE(cls.min_change_percent, 0)
+
+        # Наибольшее изменение среди выбранных пользователем валют. Подзапрос идет
+        # по индексу (user_id, currency_char_code), для пользователя без изменившихся валют будет NULL
+        max_change_percent = (
+            SelectedCurrency
+            .select(fn.MAX(Case(SelectedCurrency.currency_char_code, list(changes.items()))))
+            .where(
+                SelectedCurrency.user_id == cls.user_id,
+                SelectedCurrency.currency_char_code.in_(list(changes)),
+            )
+        )
+        condition = min_change_percent <= max_change_percent
+
+        # Пользователи без записей в SelectedCurrency получают DEFAULT_CURRENCY_CHAR_CODES
+        default_changes = [
+            changes[char_code] for char_code in DEFAULT_CURRENCY_CHAR_CODES if char_code in changes
+        ]
+        if default_changes:
+            has_selection = fn.EXISTS(
+                SelectedCurrency.select(SelectedCurrency.id).where(SelectedCurrency.user_id == cls.user_id)
+            )
+            condition |= ~has_selection & (min_change_percent <= max(default_changes))
+
+        future = cls._meta.database.submit(
+            cls.update(was_sending=False).where(cls.is_active == True, condition)
+        )
+        return future.result(timeout=DB_WRITE_TIMEOUT)
+
+    def set_min_change_percent(self, value: Optional[float]):
+        self.min_change_percent = value
+        self.modification_datetime = DT.datetime.now()
+        self.save()
+
     @classmethod
     def has_is_active(cls, user_id: int) -> bool:
-        return bool(cls.get_or_none(cls.user_id == user_id, cls.is_active == True))
+        is_active = subscription_cache.get(user_id)
+        if is_active is None:
+            is_active = bool(cls.get_or_none(cls.user_id == user_id, cls.is_active == True))
+            subscription_cache.set(user_id, is_active)
+
+        return is_active
 
     def set_active(self, active: bool):
         self.is_active = active
@@ -433,20 +960,16 @@ class Subscription(BaseModel):
 
 
 class Settings(BaseModel):
+    # Устаревшее поле: валюты через запятую. Выбранные валюты хранятся в SelectedCurrency,
+    # а значения отсюда переносятся туда при запуске в migrate_selected_currencies
     selected_currencies = TextField(default="")
 
     @classmethod
     def get_by(cls, user_id: int) -> Optional["Settings"]:
         return cls.get_or_none(id=user_id)
 
-    @classmethod
-    def get_selected_currencies(cls, user_id: int) -> list[str]:
-        settings = cls.get_by(user_id)
-        if not settings:
-            return DEFAULT_CURRENCY_CHAR_CODES
-
-        selected_currencies = settings.selected_currencies.split(",")
-
+    @staticmethod
+    def get_sorted_currencies(selected_currencies: list[str]) -> list[str]:
         # Сначала добавляем валюты из списка
         currency_char_codes = [
             char_code
@@ -459,29 +982,244 @@ class Settings(BaseModel):
 
         return currency_char_codes
 
+    @classmethod
+    def get_selected_currencies(cls, user_id: int) -> list[str]:
+        selected_currencies = settings_cache.get(user_id)
+        if selected_currencies is None:
+            selected_currencies = cls.get_sorted_currencies(
+                SelectedCurrency.get_char_codes(user_id) or DEFAULT_CURRENCY_CHAR_CODES
+            )
+            settings_cache.set(user_id, selected_currencies)
+
+        # Копия, чтобы изменения списка вызывающим кодом не попали в кэш
+        return list(selected_currencies)
+
+    @classmethod
+    def get_selected_currencies_by_user_ids(
+        cls, user_ids: list[int]
+    ) -> dict[int, list[str]]:
+        # Настройки всех пользователей получаются одним запросом
+        char_codes_by_user_id = SelectedCurrency.get_char_codes_by_user_ids(user_ids)
+        return {
+            user_id: cls.get_sorted_currencies(
+                char_codes_by_user_id.get(user_id) or DEFAULT_CURRENCY_CHAR_CODES
+            )
+            for user_id in user_ids
+        }
+
     @classmethod
     def set_selected_currencies(cls, user_id: int, items: list[str]):
-        text = ",".join(items)
-        if text == cls.get_selected_currencies(user_id):
+        selected_currencies = cls.get_sorted_currencies(items)
+        if selected_currencies == cls.get_selected_currencies(user_id):
             return
 
-        settings = cls.get_by(user_id)
-        if not settings:
-            settings = cls.create(id=user_id)
+        # Меняются только отличающиеся строки: при переключении одной валюты
+        # в настройках это один INSERT или один DELETE
+        char_codes = SelectedCurrency.get_char_codes(user_id)
+
+        removed = [char_code for char_code in char_codes if char_code not in items]
+        if removed:
+            SelectedCurrency.delete().where(
+                SelectedCurrency.user_id == user_id,
+                SelectedCurrency.currency_char_code.in_(removed),
+            ).execute()
+
+        added = [char_code for char_code in selected_currencies if char_code not in char_codes]
+        if added:
+            SelectedCurrency.insert_many_ignore(
+                [(user_id, char_code) for char_code in added],
+                fields=[SelectedCurrency.user_id, SelectedCurrency.currency_char_code],
+            )
+
+        settings_cache.set(user_id, selected_currencies)
+
+
+class SelectedCurrency(BaseModel):
+    """
+    Валюты, выбранные пользователем в настройках. Если у пользователя
+    нет ни одной записи, то используются DEFAULT_CURRENCY_CHAR_CODES.
+    Валюты возвращаются в порядке сетки настроек: по коду валюты, а
+    DEFAULT_CURRENCY_CHAR_CODES переносит вперед Settings.get_sorted_currencies
+    """
+
+    user_id = IntegerField()
+    currency_char_code = TextField(index=True)
+
+    class Meta:
+        indexes = (
+            (("user_id", "currency_char_code"), True),
+        )
+
+    @classmethod
+    def get_char_codes(cls, user_id: int) -> list[str]:
+        query = (
+            cls.select(cls.currency_char_code)
+            .where(cls.user_id == user_id)
+            .order_by(cls.currency_char_code)
+            .tuples()
+        )
+        return [char_code for char_code, in query]
+
+    @classmethod
+    def get_char_codes_by_user_ids(cls, user_ids: list[int]) -> dict[int, list[str]]:
+        query = (
+            cls.select(cls.user_id, cls.currency_char_code)
+            .where(cls.user_id.in_(user_ids))
+            .order_by(cls.currency_char_code)
+            .tuples()
+        )
+
+        char_codes_by_user_id: dict[int, list[str]] = dict()
+        for user_id, char_code in query:
+            char_codes_by_user_id.setdefault(user_id, []).append(char_code)
 
-        settings.selected_currencies = text
-        settings.save()
+        return char_codes_by_user_id
 
+    @classmethod
+    def get_user_ids_with_selection(cls) -> set[int]:
+        return {user_id for user_id, in cls.select(cls.user_id).distinct().tuples()}
+
+
+def migrate_columns():
+    """
+    Добавление в существующие таблицы колонок, которые появились в моделях позже.
+    create_tables создает только отсутствующие таблицы
+    """
+
+    migrator = SqliteMigrator(db)
+    operations = []
+    for model in BaseModel.get_inherited_models():
+        table_name = model._meta.table_name
+        column_names = {column.name for column in db.get_columns(table_name)}
+        for field in model._meta.sorted_fields:
+            if field.column_name not in column_names:
+                operations.append(migrator.add_column(table_name, field.column_name, field))
+
+    if operations:
+        migrate(*operations)
+        db.flush()
+
+
+def migrate_selected_currencies() -> int:
+    """
+    Перенос валют из Settings.selected_currencies в SelectedCurrency для пользователей,
+    у которых еще нет записей в SelectedCurrency. Возвращает количество добавленных строк
+    """
 
-db.connect()
-db.create_tables(BaseModel.get_inherited_models())
+    migrated_user_ids = SelectedCurrency.get_user_ids_with_selection()
 
-# Задержка в 50мс, чтобы дать время на запуск SqliteQueueDatabase и создание таблиц
-# Т.к. в SqliteQueueDatabase запросы на чтение выполняются сразу, а на запись попадают в очередь
-time.sleep(0.050)
+    rows = []
+    for settings in Settings.select().where(Settings.selected_currencies != ""):
+        if settings.id in migrated_user_ids:
+            continue
+
+        for char_code in settings.selected_currencies.split(","):
+            if char_code:
+                rows.append((settings.id, char_code))
+
+    if not rows:
+        return 0
+
+    return SelectedCurrency.insert_many_ignore(
+        rows, fields=[SelectedCurrency.user_id, SelectedCurrency.currency_char_code]
+    )
+
+
+class ChartFile(BaseModel):
+    """
+    Идентификаторы файлов, которые Telegram вернул после загрузки графиков.
+    Повторно такой же график отправляется по file_id, без загрузки картинки
+    """
+
+    currency_char_code = TextField()
+    number = IntegerField()
+    year = IntegerField(default=0)  # 0, если график не за год
+    last_date = DateField()
+    file_id = TextField()
+    creation_datetime = DateTimeField(default=DT.datetime.now)
+
+    class Meta:
+        indexes = (
+            (("currency_char_code", "number", "year", "last_date"), True),
+        )
+
+    @classmethod
+    def get_file_id(
+        cls,
+        currency_char_code: str,
+        number: int,
+        year: Optional[int],
+        last_date: DT.date,
+    ) -> Optional[str]:
+        obj = cls.get_or_none(
+            cls.currency_char_code == currency_char_code,
+            cls.number == number,
+            cls.year == (year or 0),
+            cls.last_date == last_date,
+        )
+        return obj.file_id if obj else None
+
+    @classmethod
+    def set_file_id(
+        cls,
+        currency_char_code: str,
+        number: int,
+        year: Optional[int],
+        last_date: DT.date,
+        file_id: str,
+    ):
+        # Графики по прошлым датам больше не понадобятся
+        cls.delete().where(
+            cls.currency_char_code == currency_char_code,
+            cls.number == number,
+            cls.year == (year or 0),
+            cls.last_date < last_date,
+        ).execute()
+
+        cls.insert(
+            currency_char_code=currency_char_code,
+            number=number,
+            year=year or 0,
+            last_date=last_date,
+            file_id=file_id,
+        ).on_conflict_replace().execute()
+
+    @classmethod
+    def remove_file_id(cls, file_id: str):
+        cls.delete().where(cls.file_id == file_id).execute()
+
+
+_init_lock = threading.Lock()
+_is_initialized: bool = False
+
+
+def init():
+    """
+    Подключение к базе и создание таблиц. Повторные вызовы ничего не делают
+    """
+
+    global _is_initialized
+
+    with _init_lock:
+        if _is_initialized:
+            return
+
+        db.connect(reuse_if_open=True)
+        db.create_tables(BaseModel.get_inherited_models())
+
+        # В SqliteQueueDatabase запросы на чтение выполняются сразу, а на запись попадают
+        # в очередь, поэтому перед чтением нужно дождаться создания таблиц
+        db.flush()
+
+        migrate_columns()
+        migrate_selected_currencies()
+
+        _is_initialized = True
 
 
 if __name__ == "__main__":
+    init()
+
     BaseModel.print_count_of_tables()
 
     print()
@@ -517,6 +1255,13 @@ if __name__ == "__main__":
             year + 1,
         ), f"Неправильно определилось значение для {year}"
 
+    last_date = ExchangeRate.get_last_date()
+    all_currency_char_codes = Currency.get_all_char_codes()
+    for char_code, (rate, prev_rate) in ExchangeRate.get_rates_with_prev(
+        last_date, all_currency_char_codes
+    ).items():
+        assert rate.get_description() == rate.get_description_with(prev_rate)
+
     assert Currency.get_by(number_code=36) == Currency.get_by(number_code="36")
     assert Currency.get_by(number_code=36) == Currency.get_by(number_code="036")
     assert Currency.get_by(number_code=36) == Currency.get_by(char_code="AUD")
@@ -529,6 +1274,10 @@ if __name__ == "__main__":
     assert sorted(all_currency_char_codes) == sorted(
         Settings.get_selected_currencies(user_id=user_id)
     )
+    assert Settings.get_selected_currencies_by_user_ids([user_id, -2]) == {
+        user_id: Settings.get_selected_currencies(user_id=user_id),
+        -2: DEFAULT_CURRENCY_CHAR_CODES,
+    }
 
     from root_config import MAX_MESSAGE_LENGTH
     assert len(Currency.get_full_description()) <= MAX_MESSAGE_LENGTH
@@ -5,12 +5,15 @@ __author__ = "ipetrash"
 
 
 import os
+import sys
 import time
 
 # pip install python-telegram-bot
 from telegram.ext import Updater, Defaults
 
-from root_config import TOKEN
+import db
+from root_common import ProcessLock
+from root_config import BOT_LOCK_FILE_NAME, get_token
 
 from bot import commands
 from bot.common import log
@@ -26,7 +29,7 @@ def main():
     log.debug(f"System: CPU_COUNT={cpu_count}, WORKERS={workers}")
 
     updater = Updater(
-        TOKEN,
+        get_token(),
         workers=workers,
         defaults=Defaults(run_async=True),
     )
@@ -43,6 +46,14 @@ def main():
 
 
 if __name__ == "__main__":
+    # Блокировка держится все время работы бота и не дает запустить
+    # второй экземпляр или восстановление базы из архива (parser/main.py --replay)
+    bot_lock = ProcessLock(BOT_LOCK_FILE_NAME)
+    if not bot_lock.acquire():
+        log.error(f"Бот уже запущен (занят {BOT_LOCK_FILE_NAME})")
+        sys.exit(1)
+
+    db.init()
     backgrounds_tasks.run()
 
     while True:
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import gzip
+import threading
+from pathlib import Path
+from typing import Optional
+
+
+class PayloadArchive:
+    """
+    Архив ответов сайта ЦБ.
+    Ответы сжимаются gzip и дописываются в конец файла данных, а в файл индекса
+    дописывается строка "ключ<TAB>смещение<TAB>размер". Для повторного ключа
+    действует последняя запись
+    """
+
+    def __init__(self, dir_path: Path):
+        self.dir_path = Path(dir_path)
+        self.data_path = self.dir_path / "archive.dat"
+        self.index_path = self.dir_path / "archive.idx"
+
+        self._lock = threading.Lock()
+        self._offset_by_key: Optional[dict[str, tuple[int, int]]] = None
+
+    def _load_index(self) -> dict[str, tuple[int, int]]:
+        if self._offset_by_key is not None:
+            return self._offset_by_key
+
+        offset_by_key = dict()
+        if self.index_path.exists():
+            with open(self.index_path, encoding="utf-8") as f:
+                for line in f:
+                    # Недописанная строка (например, после падения) пропускается
+                    if not line.endswith("\n"):
+                        continue
+
+                    key, offset, size = line.rstrip("\n").split("\t")
+                    offset_by_key[key] = int(offset), int(size)
+
+        self._offset_by_key = offset_by_key
+        return offset_by_key
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._load_index()
+
+    def keys(self, prefix: str = "") -> list[str]:
+        with self._lock:
+            return sorted(key for key in self._load_index() if key.startswith(prefix))
+
+    def put(self, key: str, content: bytes, overwrite: bool = False) -> bool:
+        """
+        Возвращает True, если запись была добавлена
+        """
+
+        with self._lock:
+            offset_by_key = self._load_index()
+            if key in offset_by_key and not overwrite:
+                return False
+
+            self.dir_path.mkdir(parents=True, exist_ok=True)
+
+            data = gzip.compress(content)
+            with open(self.data_path, "ab") as f:
+                offset = f.tell()
+                f.write(data)
+
+            # Индекс пишется после данных, чтобы не ссылаться на недописанную запись
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(f"{key}\t{offset}\t{len(data)}\n")
+
+            offset_by_key[key] = offset, len(data)
+            return True
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._load_index().get(key)
+            if not item:
+                return
+
+            offset, size = item
+            with open(self.data_path, "rb") as f:
+                f.seek(offset)
+                return gzip.decompress(f.read(size))
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        archive = PayloadArchive(dir_path)
+        assert archive.put("XML_daily/2022-04-01", b"1")
+        assert not archive.put("XML_daily/2022-04-01", b"2")
+        assert archive.put("XML_daily/2022-04-02", b"3")
+        assert archive.put("XML_daily/2022-04-01", b"4", overwrite=True)
+
+        archive = PayloadArchive(dir_path)
+        assert archive.keys() == ["XML_daily/2022-04-01", "XML_daily/2022-04-02"]
+        assert archive.get("XML_daily/2022-04-01") == b"4"
+        assert archive.get("XML_daily/2022-04-02") == b"3"
+        assert archive.get("XML_daily/2022-04-03") is None
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Сравнение скорости разбора ответов XML_daily.asp: потоковый разбор через
+# xml.etree.ElementTree.iterparse против прежнего BeautifulSoup(..., "html.parser").
+# Запуск: python parser/benchmark_xml.py [<папка с XML_daily>]
+
+
+import datetime as DT
+import sys
+import timeit
+from decimal import Decimal
+from pathlib import Path
+
+# pip install beautifulsoup4
+from bs4 import BeautifulSoup
+
+from parser.config import DIR_FIXTURES
+from parser.main import Currency, parse_daily, DATE_FORMAT_REQ
+
+
+def parse_daily_bs4(content: bytes) -> tuple[DT.date, dict[str, Currency]]:
+    """
+    Прежняя реализация из get_currencies
+    """
+
+    root = BeautifulSoup(content, "html.parser")
+
+    currency_by_value = dict()
+    date = DT.datetime.strptime(root.valcurs["date"], DATE_FORMAT_REQ).date()
+
+    for el in root.find_all("valute"):
+        nominal = int(el.select_one("nominal").string)
+        value = Decimal(el.select_one("value").string.replace(",", "."))
+
+        currency = Currency(
+            num_code=int(el.select_one("numcode").string),
+            char_code=el.select_one("charcode").string,
+            name=el.select_one("name").string,
+            nominal=nominal,
+            value=value,
+            raw_value=value / nominal,
+            cbr_id=el["id"],
+        )
+        currency_by_value[currency.char_code] = currency
+
+    return date, currency_by_value
+
+
+def run(files: list[Path], number: int = 200):
+    contents = [path.read_bytes() for path in files]
+
+    # Результаты обеих реализаций должны совпадать
+    for path, content in zip(files, contents):
+        assert parse_daily(content) == parse_daily_bs4(content), path
+
+    print(f"Файлов: {len(files)}, повторов: {number}")
+
+    results = dict()
+    for name, func in [
+        ("BeautifulSoup", parse_daily_bs4),
+        ("iterparse", parse_daily),
+    ]:
+        elapsed = timeit.timeit(
+            lambda: [func(content) for content in contents],
+            number=number,
+        )
+        results[name] = elapsed
+        print(f"{name:15}: {elapsed:.3f} секунд, {elapsed / number / len(files) * 1000:.3f} мс на файл")
+
+    print(f"Ускорение: x{results['BeautifulSoup'] / results['iterparse']:.1f}")
+
+
+if __name__ == "__main__":
+    fixtures_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else DIR_FIXTURES / "XML_daily"
+    run(sorted(fixtures_dir.glob("*.xml")))
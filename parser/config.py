@@ -5,6 +5,42 @@ __author__ = "ipetrash"
 
 
 import datetime as DT
+import os
+from pathlib import Path
 
 
+DIR = Path(__file__).resolve().parent
+
+# Сохраненные ответы сайта ЦБ для проверок и бенчмарков
+DIR_FIXTURES: Path = DIR / "fixtures"
+
+# Архив всех загруженных ответов сайта ЦБ, из него можно восстановить базу без сети
+ARCHIVE_ENABLED: bool = False
+DIR_ARCHIVE: Path = DIR / "archive"
+
 START_DATE: DT.date = DT.date(year=2000, month=1, day=1)
+
+# Для проверок можно указать адрес локального сервера, например, parser/fake_cbr_server.py
+URL_CBR: str = os.environ.get("URL_CBR", "https://www.cbr.ru").rstrip("/")
+
+FETCH_CONNECT_TIMEOUT: float = 10
+FETCH_READ_TIMEOUT: float = 60
+FETCH_RETRIES: int = 3
+FETCH_POOL_SIZE: int = 8
+
+# Задержка перед повтором после ошибки растет от BACKOFF_START_SECS до BACKOFF_MAX_SECS
+BACKOFF_START_SECS: int = 60
+BACKOFF_MAX_SECS: int = 4 * 3600
+
+# Если пропущено больше дней, то они будут загружаться параллельно
+BACKFILL_MIN_DAYS: int = 7
+
+# Загрузка через XML_dynamic.asp (запрос на каждую валюту за весь диапазон),
+# иначе - через XML_daily.asp (запрос на каждый день)
+BACKFILL_BY_RANGE: bool = True
+BACKFILL_WORKERS: int = 4
+
+# Ограничение частоты запросов к сайту ЦБ при параллельной загрузке
+BACKFILL_REQUESTS_PER_SECOND: float = 2
+
+BACKFILL_LOG_EVERY_DAYS: int = 100
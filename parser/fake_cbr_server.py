@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Локальный сервер, который отдает сохраненные ответы сайта ЦБ.
+# Нужен, чтобы проверять парсер без обращения к cbr.ru:
+#     python parser/fake_cbr_server.py <fixtures>
+#     URL_CBR=http://127.0.0.1:8000 python parser/main.py
+#
+# Ответы XML_daily.asp лежат в <fixtures>/XML_daily/<YYYY-MM-DD>.xml, где дата
+# в имени файла совпадает с атрибутом Date у ValCurs.
+# Ответы XML_dynamic.asp собираются из тех же файлов
+
+
+import argparse
+import datetime as DT
+import hashlib
+import threading
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+
+DATE_FORMAT_REQ: str = "%d.%m.%Y"
+
+
+def get_daily_file(fixtures_dir: Path, date_req: DT.date = None) -> Path:
+    """
+    Как и сайт ЦБ, для даты без данных возвращает ближайшие предыдущие данные
+    """
+
+    files = sorted((fixtures_dir / "XML_daily").glob("*.xml"))
+    if not files:
+        raise FileNotFoundError(f"Нет файлов в {fixtures_dir / 'XML_daily'}")
+
+    if not date_req:
+        return files[-1]
+
+    result = files[0]
+    for path in files:
+        if DT.date.fromisoformat(path.stem) > date_req:
+            break
+        result = path
+
+    return result
+
+
+def get_dynamic_content(
+    fixtures_dir: Path,
+    cbr_id: str,
+    start_date: DT.date,
+    end_date: DT.date,
+) -> bytes:
+    root = ET.Element(
+        "ValCurs",
+        ID=cbr_id,
+        DateRange1=start_date.strftime(DATE_FORMAT_REQ),
+        DateRange2=end_date.strftime(DATE_FORMAT_REQ),
+        name="Foreign Currency Market Dynamic",
+    )
+
+    for path in sorted((fixtures_dir / "XML_daily").glob("*.xml")):
+        date = DT.date.fromisoformat(path.stem)
+        if not start_date <= date <= end_date:
+            continue
+
+        daily = ET.fromstring(path.read_bytes())
+        valute = daily.find(f"Valute[@ID='{cbr_id}']")
+        if valute is None:
+            continue
+
+        record = ET.SubElement(
+            root, "Record", Date=date.strftime(DATE_FORMAT_REQ), Id=cbr_id
+        )
+        for tag in ("Nominal", "Value"):
+            ET.SubElement(record, tag).text = valute.findtext(tag)
+
+    return ET.tostring(root, encoding="windows-1251", xml_declaration=True)
+
+
+class FakeCbrHandler(BaseHTTPRequestHandler):
+    fixtures_dir: Path = None
+    requests: list[str] = None
+
+    def send_content(self, content: bytes, content_type: str = "application/xml; charset=windows-1251"):
+        etag = f'"{hashlib.md5(content).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.requests.append(self.path)
+
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if url.path == "/scripts/XML_daily.asp":
+            date_req = params.get("date_req")
+            if date_req:
+                date_req = DT.datetime.strptime(date_req, DATE_FORMAT_REQ).date()
+
+            path = get_daily_file(self.fixtures_dir, date_req)
+            self.send_content(path.read_bytes())
+            return
+
+        if url.path == "/scripts/XML_dynamic.asp":
+            content = get_dynamic_content(
+                self.fixtures_dir,
+                cbr_id=params["VAL_NM_RQ"],
+                start_date=DT.datetime.strptime(params["date_req1"], DATE_FORMAT_REQ).date(),
+                end_date=DT.datetime.strptime(params["date_req2"], DATE_FORMAT_REQ).date(),
+            )
+            self.send_content(content)
+            return
+
+        self.send_error(404)
+
+    def log_message(self, format: str, *args):
+        pass
+
+
+def create_server(
+    fixtures_dir: Path,
+    host: str = "127.0.0.1",
+    port: int = 0,
+) -> ThreadingHTTPServer:
+    """
+    При port=0 порт будет выбран свободный, адрес можно узнать через get_url.
+    Список путей запросов доступен в server.RequestHandlerClass.requests
+    """
+
+    handler_cls = type(
+        "Handler",
+        (FakeCbrHandler,),
+        dict(fixtures_dir=Path(fixtures_dir), requests=[]),
+    )
+    return ThreadingHTTPServer((host, port), handler_cls)
+
+
+def start_server(
+    fixtures_dir: Path,
+    host: str = "127.0.0.1",
+    port: int = 0,
+) -> ThreadingHTTPServer:
+    """
+    Запуск сервера в фоновом потоке
+    """
+
+    server = create_server(fixtures_dir, host, port)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def get_url(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальный сервер с ответами сайта ЦБ")
+    parser.add_argument("fixtures_dir", type=Path)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    server = create_server(args.fixtures_dir, args.host, args.port)
+    print(f"Сервер запущен: {get_url(server)}")
+    server.serve_forever()
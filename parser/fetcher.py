@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import hashlib
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from parser.config import (
+    FETCH_CONNECT_TIMEOUT,
+    FETCH_READ_TIMEOUT,
+    FETCH_RETRIES,
+    FETCH_POOL_SIZE,
+    BACKOFF_START_SECS,
+    BACKOFF_MAX_SECS,
+)
+
+
+def get_backoff_timeout(
+    attempt: int,
+    start: float = BACKOFF_START_SECS,
+    maximum: float = BACKOFF_MAX_SECS,
+) -> float:
+    """
+    Экспоненциальная задержка перед повтором: start, start * 2, start * 4, ..., но не больше maximum
+    """
+
+    return min(maximum, start * 2 ** (attempt - 1))
+
+
+@dataclass
+class Validators:
+    etag: Optional[str]
+    last_modified: Optional[str]
+    digest: str
+
+
+class Fetcher:
+    """
+    Загрузка страниц через одну сессию с пулом соединений и таймаутами.
+    Для only_modified=True запоминает ETag, Last-Modified и хэш ответа и,
+    если содержимое не изменилось с прошлого запроса, возвращает None.
+    Новые значения начинают действовать только после вызова commit, когда
+    вызывающий код обработал ответ, иначе после ошибки обработки ответ
+    считался бы уже полученным
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = FETCH_CONNECT_TIMEOUT,
+        read_timeout: float = FETCH_READ_TIMEOUT,
+        retries: int = FETCH_RETRIES,
+        pool_size: int = FETCH_POOL_SIZE,
+    ):
+        self.timeout = connect_timeout, read_timeout
+
+        self.session = requests.Session()
+
+        # Повторы при ошибках соединения и ответах 5xx, с нарастающей задержкой
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=1,
+                status_forcelist=(500, 502, 503, 504),
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._validators_by_key: dict[tuple, Validators] = dict()
+        self._pending_validators_by_key: dict[tuple, Validators] = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(url: str, params: dict[str, str] = None) -> tuple:
+        return url, tuple(sorted((params or dict()).items()))
+
+    def get(
+        self,
+        url: str,
+        params: dict[str, str] = None,
+        only_modified: bool = False,
+    ) -> Optional[bytes]:
+        key = self._get_key(url, params)
+
+        headers = dict()
+        with self._lock:
+            prev = self._validators_by_key.get(key) if only_modified else None
+
+        if prev:
+            if prev.etag:
+                headers["If-None-Match"] = prev.etag
+            if prev.last_modified:
+                headers["If-Modified-Since"] = prev.last_modified
+
+        rs = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+        if rs.status_code == 304:
+            return
+
+        rs.raise_for_status()
+
+        content = rs.content
+        if not only_modified:
+            return content
+
+        validators = Validators(
+            etag=rs.headers.get("ETag"),
+            last_modified=rs.headers.get("Last-Modified"),
+            digest=hashlib.sha256(content).hexdigest(),
+        )
+        # Сервер мог не поддержать условные запросы, тогда сравниваем содержимое.
+        # Такой ответ уже был обработан, поэтому его значения сохраняются сразу
+        if prev and prev.digest == validators.digest:
+            with self._lock:
+                self._validators_by_key[key] = validators
+            return
+
+        with self._lock:
+            self._pending_validators_by_key[key] = validators
+
+        return content
+
+    def commit(self, url: str, params: dict[str, str] = None):
+        """
+        Подтверждение, что последний ответ для only_modified=True обработан
+        """
+
+        key = self._get_key(url, params)
+        with self._lock:
+            validators = self._pending_validators_by_key.pop(key, None)
+            if validators:
+                self._validators_by_key[key] = validators
+
+
+if __name__ == "__main__":
+    from parser.config import DIR_FIXTURES
+    from parser.fake_cbr_server import start_server, get_url
+
+    assert [get_backoff_timeout(i, start=60, maximum=600) for i in range(1, 7)] == [
+        60, 120, 240, 480, 600, 600
+    ]
+
+    server = start_server(DIR_FIXTURES)
+    url = f"{get_url(server)}/scripts/XML_daily.asp"
+    params = dict(date_req="01.04.2022")
+
+    fetcher = Fetcher()
+    assert fetcher.get(url, params)
+    assert fetcher.get(url, params)  # Без only_modified ответ всегда возвращается
+
+    assert fetcher.get(url, params, only_modified=True)
+    assert fetcher.get(url, params, only_modified=True)  # Без commit ответ возвращается снова
+    fetcher.commit(url, params)
+    assert fetcher.get(url, params, only_modified=True) is None
+    assert fetcher.get(url, dict(date_req="02.04.2022"), only_modified=True)
+
+    server.shutdown()
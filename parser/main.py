@@ -4,22 +4,50 @@
 __author__ = "ipetrash"
 
 
+import argparse
 import datetime as DT
 import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from decimal import Decimal
-from typing import Iterator
-
-import requests
-from bs4 import BeautifulSoup, Tag
+from io import BytesIO
+from typing import Iterable, Iterator, Optional
 
 import db
-from root_common import get_date_str, caller_name, get_logger
-from root_config import DIR_LOGS
+from parser.archive import PayloadArchive
+from parser.config import (
+    URL_CBR,
+    ARCHIVE_ENABLED,
+    DIR_ARCHIVE,
+    BACKFILL_MIN_DAYS,
+    BACKFILL_BY_RANGE,
+    BACKFILL_WORKERS,
+    BACKFILL_REQUESTS_PER_SECOND,
+    BACKFILL_LOG_EVERY_DAYS,
+)
+from parser.fetcher import Fetcher, get_backoff_timeout
+from root_common import get_date_str, caller_name, get_logger, ProcessLock, TokenBucket
+from root_config import BOT_LOCK_FILE_NAME, DIR_LOGS
 
 
 log = get_logger(__file__, DIR_LOGS / "parser.txt")
 
+fetcher = Fetcher()
+archive = PayloadArchive(DIR_ARCHIVE)
+
+
+DATE_FORMAT_REQ: str = "%d.%m.%Y"
+
+
+def parse_value(text: str) -> Decimal:
+    # В ответах ЦБ дробная часть отделяется запятой
+    return Decimal(text.replace(",", "."))
+
+
+def parse_date(text: str) -> DT.date:
+    return DT.datetime.strptime(text, DATE_FORMAT_REQ).date()
+
 
 @dataclass
 class Currency:
@@ -29,20 +57,22 @@ class Currency:
     nominal: int
     value: Decimal
     raw_value: Decimal
+    cbr_id: str = ""  # Внутренний код ЦБ, например, R01235
 
     @classmethod
-    def parse_from(cls, el: Tag) -> "Currency":
-        nominal = int(el.select_one("nominal").string)
-        value = Decimal(el.select_one("value").string.replace(",", "."))
+    def parse_from(cls, el: ET.Element) -> "Currency":
+        nominal = int(el.findtext("Nominal"))
+        value = parse_value(el.findtext("Value"))
         raw_value = value / nominal
 
         return cls(
-            num_code=int(el.select_one("numcode").string),
-            char_code=el.select_one("charcode").string,
-            name=el.select_one("name").string,
+            num_code=int(el.findtext("NumCode")),
+            char_code=el.findtext("CharCode"),
+            name=el.findtext("Name"),
             nominal=nominal,
             value=value,
             raw_value=raw_value,
+            cbr_id=el.get("ID", ""),
         )
 
 
@@ -66,61 +96,343 @@ def iter_dates(start_date: DT.date, end_date: DT.date = None) -> Iterator[DT.dat
         date_req1 = date_req2
 
 
-def get_currencies(date: DT.date) -> tuple[DT.date, dict[str, Currency]]:
-    date_fmt = "%d.%m.%Y"
-    date_req = date.strftime(date_fmt)
+def parse_daily(content: bytes) -> tuple[DT.date, dict[str, Currency]]:
+    """
+    Разбор ответа XML_daily.asp. XML читается потоково, кодировка
+    (windows-1251) берется из его заголовка
+    """
 
-    url = "https://www.cbr.ru/scripts/XML_daily.asp"
+    date = None
+    currency_by_value = dict()
 
-    rs = requests.get(url, params=dict(date_req=date_req))
-    root = BeautifulSoup(rs.content, "html.parser")
+    for event, el in ET.iterparse(BytesIO(content), events=("start", "end")):
+        if event == "start":
+            if el.tag == "ValCurs":
+                date = parse_date(el.get("Date"))
 
-    currency_by_value = dict()
-    date = DT.datetime.strptime(root.valcurs["date"], date_fmt).date()
+        elif el.tag == "Valute":
+            currency = Currency.parse_from(el)
+            currency_by_value[currency.char_code] = currency
 
-    for s in root.find_all("valute"):
-        currency = Currency.parse_from(s)
-        currency_by_value[currency.char_code] = currency
+            # Обработанные элементы больше не нужны
+            el.clear()
 
     return date, currency_by_value
 
 
-def parse(date_req: DT.date, prefix: str = "[parse]"):
-    date, currency_by_value = get_currencies(date_req)
-    log.debug(f"{prefix} Получена дата {date}, валют {len(currency_by_value)}")
+def parse_dynamic(content: bytes) -> dict[DT.date, Decimal]:
+    """
+    Разбор ответа XML_dynamic.asp: курс валюты (за единицу) по датам
+    """
 
-    # Не за все даты на сайте есть информация
-    if date != date_req:
+    rate_by_date = dict()
+
+    for _, el in ET.iterparse(BytesIO(content)):
+        if el.tag == "Record":
+            nominal = int(el.findtext("Nominal"))
+            value = parse_value(el.findtext("Value"))
+            rate_by_date[parse_date(el.get("Date"))] = value / nominal
+
+            el.clear()
+
+    return rate_by_date
+
+
+def get_daily_request(date: DT.date) -> tuple[str, dict[str, str]]:
+    return f"{URL_CBR}/scripts/XML_daily.asp", dict(date_req=date.strftime(DATE_FORMAT_REQ))
+
+
+def get_currencies(
+    date: DT.date,
+    only_modified: bool = False,
+) -> Optional[tuple[DT.date, dict[str, Currency]]]:
+    """
+    При only_modified=True вернет None, если ответ не изменился с прошлого запроса.
+    После обработки ответа нужно вызвать fetcher.commit(*get_daily_request(date))
+    """
+
+    url, params = get_daily_request(date)
+
+    content = fetcher.get(url, params=params, only_modified=only_modified)
+    if content is None:
         return
 
-    old_count = db.ExchangeRate.count()
-    for currency_char_code, currency in currency_by_value.items():
-        number_code = currency.num_code
-        if not db.Currency.get_by(number_code=number_code):
-            db.Currency.add(
-                number_code=number_code,
-                char_code=currency.char_code,
-                title=currency.name,
-            )
-            log.info(f"{prefix} Добавлена валюта: {currency}")
-
-        rate = db.ExchangeRate.get_by(date=date, currency_char_code=currency_char_code)
-        if not rate:
-            value = currency.raw_value
-            db.ExchangeRate.add(
-                date=date,
-                currency_char_code=currency_char_code,
-                value=value,
-            )
-            log.info(
-                f"{prefix} За {get_date_str(date)} добавлено {currency_char_code} = {value}"
-            )
+    date, currency_by_value = parse_daily(content)
+    if ARCHIVE_ENABLED:
+        archive.put(f"XML_daily/{date.isoformat()}", content)
+
+    return date, currency_by_value
+
+
+def get_currency_rates(
+    currency: Currency,
+    start_date: DT.date,
+    end_date: DT.date,
+) -> dict[DT.date, Decimal]:
+    """
+    Получение курса валюты за диапазон дат одним запросом
+    """
+
+    url = f"{URL_CBR}/scripts/XML_dynamic.asp"
+
+    content = fetcher.get(
+        url,
+        params=dict(
+            date_req1=start_date.strftime(DATE_FORMAT_REQ),
+            date_req2=end_date.strftime(DATE_FORMAT_REQ),
+            VAL_NM_RQ=currency.cbr_id,
+        ),
+    )
+    if ARCHIVE_ENABLED:
+        archive.put(
+            f"XML_dynamic/{currency.char_code}/{start_date.isoformat()}_{end_date.isoformat()}",
+            content,
+        )
+
+    return parse_dynamic(content)
+
+
+def add_rates(
+    currencies: Iterable[Currency],
+    rates: Iterable[tuple[DT.date, str, Decimal]],
+    prefix: str = "[add_rates]",
+    replace: bool = False,
+    notify: bool = True,
+) -> int:
+    """
+    Сохранение валют и их курсов (дата, код валюты, значение) в базу.
+    При replace=True значения уже сохраненных курсов исправляются.
+    При notify=False рассылка не планируется и событие о новых курсах не отправляется.
+    Возвращает количество добавленных (и исправленных) курсов
+    """
+
+    currency_count = db.Currency.add_many(
+        (currency.num_code, currency.char_code, currency.name)
+        for currency in currencies
+    )
+    if currency_count > 0:
+        log.info(f"{prefix} Добавлено {currency_count} валют")
+
+    last_date = db.ExchangeRate.get_last_date()
+
+    if replace:
+        diff_count = db.ExchangeRate.upsert_many(rates)
+    else:
+        diff_count = db.ExchangeRate.add_many(rates)
 
-    diff_count = db.ExchangeRate.count() - old_count
     if diff_count > 0:
         log.info(f"{prefix} Добавлено {diff_count} записей\n")
 
-        db.Subscription.update(was_sending=False).execute()
+        if replace:
+            # Исправленные значения через refresh не подгрузятся, поэтому кэш строится заново
+            db.ExchangeRate.clear_cache()
+
+            # Загруженные в Telegram графики могли быть построены по ошибочным курсам
+            db.db.submit(db.ChartFile.delete())
+
+        db.ExchangeRate.refresh_cache()
+
+        # Рассылка описывает курсы за последнюю дату, поэтому она нужна только при появлении
+        # новой даты и только тем, у кого изменилась хотя бы одна из выбранных валют
+        new_last_date = db.ExchangeRate.get_last_date()
+        if notify and new_last_date > last_date:
+            changes = db.ExchangeRate.get_changes(new_last_date)
+            subscription_count = db.Subscription.mark_unsent_by_changes(changes)
+            log.info(
+                f"{prefix} Изменилось валют за {new_last_date}: "
+                f"{sum(1 for change in changes.values() if change > 0)} из {len(changes)}, "
+                f"подписок для рассылки: {subscription_count}"
+            )
+
+        # Рассылка начнется только после того, как все изменения будут записаны в базу
+        db.db.flush()
+        if notify:
+            db.new_rates_event.notify()
+
+        log.debug(
+            f"{prefix} Очередь записи: {db.db.get_queue_size()}, метрики: {db.db.write_stats.get()}"
+        )
+
+    return diff_count
+
+
+def save_currencies(
+    date_req: DT.date,
+    date: DT.date,
+    currency_by_value: dict[str, Currency],
+    prefix: str = "[save_currencies]",
+):
+    # Не за все даты на сайте есть информация
+    if date != date_req:
+        return
+
+    add_rates(
+        currencies=currency_by_value.values(),
+        rates=(
+            (date, currency_char_code, currency.raw_value)
+            for currency_char_code, currency in currency_by_value.items()
+        ),
+        prefix=prefix,
+    )
+
+
+def parse(date_req: DT.date, prefix: str = "[parse]"):
+    result = get_currencies(date_req, only_modified=True)
+    if not result:
+        log.debug(f"{prefix} Ответ для {date_req} не изменился")
+        return
+
+    date, currency_by_value = result
+    log.debug(f"{prefix} Получена дата {date}, валют {len(currency_by_value)}")
+
+    save_currencies(date_req, date, currency_by_value, prefix)
+
+    # Ответ считается полученным только после сохранения курсов, иначе после ошибки
+    # повторный запрос вернул бы "не изменился" и курсы за дату не были бы сохранены
+    fetcher.commit(*get_daily_request(date_req))
+
+
+def backfill(
+    start_date: DT.date,
+    end_date: DT.date = None,
+    workers: int = BACKFILL_WORKERS,
+    requests_per_second: float = BACKFILL_REQUESTS_PER_SECOND,
+    prefix: str = "[backfill]",
+):
+    """
+    Параллельная загрузка курсов за диапазон дат.
+    Запросы выполняются в пуле потоков, а сохранение идет в одном потоке в порядке дат,
+    поэтому при ошибке загрузку можно продолжить с последней сохраненной даты
+    """
+
+    dates = list(iter_dates(start_date, end_date))
+    total = len(dates)
+
+    log.info(
+        f"{prefix} Загрузка {total} дней с {get_date_str(dates[0])} по {get_date_str(dates[-1])}, "
+        f"потоков {workers}, запросов в секунду {requests_per_second}"
+    )
+
+    bucket = TokenBucket(rate=requests_per_second)
+
+    def fetch(date_req: DT.date) -> tuple[DT.date, dict[str, Currency]]:
+        bucket.acquire()
+        return get_currencies(date_req)
+
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Результаты map возвращаются в том же порядке, что и даты
+        for i, (date_req, (date, currency_by_value)) in enumerate(
+            zip(dates, executor.map(fetch, dates)), start=1
+        ):
+            save_currencies(date_req, date, currency_by_value, prefix)
+
+            if i % BACKFILL_LOG_EVERY_DAYS == 0 or i == total:
+                elapsed = time.monotonic() - start_time
+                eta = elapsed / i * (total - i)
+                log.info(
+                    f"{prefix} Обработано {i} из {total} ({i / total:.0%}), "
+                    f"прошло {elapsed:.0f} секунд, осталось ~{eta:.0f} секунд"
+                )
+
+
+def backfill_by_range(
+    start_date: DT.date,
+    end_date: DT.date = None,
+    requests_per_second: float = BACKFILL_REQUESTS_PER_SECOND,
+    prefix: str = "[backfill_by_range]",
+):
+    """
+    Загрузка курсов за диапазон дат через XML_dynamic.asp: один запрос на каждую валюту.
+    Список валют (и их внутренние коды ЦБ) берется из XML_daily.asp на первую и последнюю даты,
+    поэтому загружаются и валюты, которые ЦБ с тех пор перестал публиковать.
+    Валюты из базы, которых нет ни в одном из этих ответов, пишутся в лог - для них есть backfill
+    """
+
+    if not end_date:
+        end_date = DT.date.today()
+
+    currency_by_value: dict[str, Currency] = dict()
+    for date_req in (end_date, start_date):
+        _, currency_by_value_for_date = get_currencies(date_req)
+        for char_code, currency in currency_by_value_for_date.items():
+            currency_by_value.setdefault(char_code, currency)
+
+    missing_char_codes = sorted(set(db.Currency.get_all_char_codes()) - set(currency_by_value))
+    if missing_char_codes:
+        log.warning(
+            f"{prefix} Для валют {', '.join(missing_char_codes)} нет кода ЦБ в ответах "
+            f"за {get_date_str(start_date)} и {get_date_str(end_date)}, они не будут загружены"
+        )
+
+    total = len(currency_by_value)
+
+    log.info(
+        f"{prefix} Загрузка {total} валют с {get_date_str(start_date)} по {get_date_str(end_date)}"
+    )
+
+    bucket = TokenBucket(rate=requests_per_second)
+
+    # Сохранение идет только после загрузки всех валют, чтобы при ошибке
+    # в базе не оказались даты с частью валют
+    rates: list[tuple[DT.date, str, Decimal]] = []
+    for i, currency in enumerate(currency_by_value.values(), start=1):
+        bucket.acquire()
+
+        rate_by_date = get_currency_rates(currency, start_date, end_date)
+        for date, value in rate_by_date.items():
+            rates.append((date, currency.char_code, value))
+
+        log.debug(
+            f"{prefix} [{i}/{total}] {currency.char_code}: получено {len(rate_by_date)} значений"
+        )
+
+    rates.sort()
+    add_rates(
+        currencies=currency_by_value.values(),
+        rates=rates,
+        prefix=prefix,
+    )
+
+
+def replay_archive(prefix: str = "[replay_archive]") -> int:
+    """
+    Восстановление валют и курсов из архива ответов без обращения к сайту ЦБ.
+    Курсы, которые уже есть в базе, заменяются значениями из архива.
+    Рассылка при этом не выполняется
+    """
+
+    currency_by_value: dict[str, Currency] = dict()
+    rates: list[tuple[DT.date, str, Decimal]] = []
+
+    keys = archive.keys("XML_daily/")
+    for key in keys:
+        date, currency_by_value_for_date = parse_daily(archive.get(key))
+        currency_by_value.update(currency_by_value_for_date)
+
+        for currency_char_code, currency in currency_by_value_for_date.items():
+            rates.append((date, currency_char_code, currency.raw_value))
+
+    keys_dynamic = archive.keys("XML_dynamic/")
+    for key in keys_dynamic:
+        # Ключ вида XML_dynamic/<код валюты>/<дата начала>_<дата конца>
+        currency_char_code = key.split("/")[1]
+        for date, value in parse_dynamic(archive.get(key)).items():
+            rates.append((date, currency_char_code, value))
+
+    log.info(
+        f"{prefix} Прочитано ответов XML_daily: {len(keys)}, XML_dynamic: {len(keys_dynamic)}, "
+        f"курсов: {len(rates)}"
+    )
+
+    rates.sort()
+    return add_rates(
+        currencies=currency_by_value.values(),
+        rates=rates,
+        prefix=prefix,
+        replace=True,
+        notify=False,
+    )
 
 
 def run_parser():
@@ -128,30 +440,54 @@ def run_parser():
 
     log.info(f"{prefix} Запуск")
 
+    # Номер попытки после ошибки, от него зависит задержка перед повтором
+    attempt = 0
+
     while True:
         start_date = db.ExchangeRate.get_last_date()
-        if db.ExchangeRate.count():  # Для существующих записей проверка идет для следующей даты
+        if db.ExchangeRate.has_date(start_date):  # Для существующих записей проверка идет для следующей даты
             start_date = get_next_date(start_date)
 
-        i = 0
-        for date_req in iter_dates(start_date):
-            log.debug(f"{prefix} Проверка для {date_req}")
+        if (DT.date.today() - start_date).days > BACKFILL_MIN_DAYS:
+            try:
+                if BACKFILL_BY_RANGE:
+                    backfill_by_range(start_date, prefix=prefix)
+                else:
+                    backfill(start_date, prefix=prefix)
+                attempt = 0
+
+            except Exception:
+                attempt += 1
+                timeout = get_backoff_timeout(attempt)
+                log.exception(f"{prefix} Ошибка (попытка {attempt}), повтор через {timeout} секунд:")
+                time.sleep(timeout)
+
+                # Загрузка продолжится с последней сохраненной даты
+                continue
+
+        else:
+            i = 0
+            for date_req in iter_dates(start_date):
+                log.debug(f"{prefix} Проверка для {date_req}")
 
-            while True:
-                try:
-                    parse(date_req, prefix=prefix)
+                while True:
+                    try:
+                        parse(date_req, prefix=prefix)
+                        attempt = 0
 
-                except Exception:
-                    log.exception(f"{prefix} Ошибка:")
-                    time.sleep(3600 * 4)  # Wait 4 hours
-                    continue
+                    except Exception:
+                        attempt += 1
+                        timeout = get_backoff_timeout(attempt)
+                        log.exception(f"{prefix} Ошибка (попытка {attempt}), повтор через {timeout} секунд:")
+                        time.sleep(timeout)
+                        continue
 
-                break
+                    break
 
-            if i > 0:
-                time.sleep(5)
+                if i > 0:
+                    time.sleep(5)
 
-            i += 1
+                i += 1
 
         time.sleep(60 * 60)  # Every 1 hour
 
@@ -159,6 +495,32 @@ def run_parser():
 
 
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Парсер курсов валют ЦБ")
+    arg_parser.add_argument(
+        "--replay",
+        action="store_true",
+        help=(
+            f"Восстановить базу из архива ответов ({DIR_ARCHIVE}) без обращения к сайту. "
+            "Бот должен быть остановлен: исправленные курсы не попадут в кэши запущенного бота"
+        ),
+    )
+    args = arg_parser.parse_args()
+
+    if args.replay:
+        # Блокировка бота не дает ему запуститься, пока идет восстановление
+        bot_lock = ProcessLock(BOT_LOCK_FILE_NAME)
+        if not bot_lock.acquire():
+            arg_parser.error(f"Бот запущен (занят {BOT_LOCK_FILE_NAME}), остановите его перед --replay")
+
+        db.init()
+
+        t = time.perf_counter()
+        replay_archive()
+        log.info(f"Восстановление из архива заняло {time.perf_counter() - t:.1f} секунд")
+        raise SystemExit()
+
+    db.init()
+
     date, currency_by_value = get_currencies(DT.date.today())
     print(
         f"Дата {get_date_str(date)}. Валют ({len(currency_by_value)}): {currency_by_value}"
@@ -5,13 +5,17 @@ __author__ = "ipetrash"
 
 
 import datetime as DT
+import enum
 import inspect
 import logging
 import sys
+import threading
+import time
 
+from collections import OrderedDict
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
-from typing import Union
+from typing import Any, Hashable, Union
 
 from root_config import DATE_FORMAT
 
@@ -28,6 +32,13 @@ def get_date_str(date: DT.date) -> str:
     return date.strftime(DATE_FORMAT)
 
 
+# SOURCE: https://github.com/gil9red/get_metal_rates/blob/6483005419c6abde470763af0b750159c1cc1290/root_common.py#L53
+class SubscriptionResultEnum(enum.Enum):
+    SUBSCRIBE_OK = enum.auto()
+    UNSUBSCRIBE_OK = enum.auto()
+    ALREADY = enum.auto()
+
+
 def caller_name() -> str:
     """Return the calling function's name."""
     return inspect.currentframe().f_back.f_code.co_name
@@ -45,6 +56,159 @@ def split_list(items: list, columns: int = 5) -> list[list]:
     return result
 
 
+class TokenBucket:
+    """
+    Ограничитель частоты: не более rate событий в секунду,
+    с накоплением до capacity токенов
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+
+        self._tokens: float = capacity
+        self._timestamp: float = time.monotonic()
+        self._paused_until: float = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds: float):
+        """
+        Остановка выдачи токенов на указанное время, например, после RetryAfter
+        """
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._timestamp = self._paused_until
+            self._tokens = 0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    timeout = self._paused_until - now
+                else:
+                    self._tokens = min(
+                        self.capacity,
+                        self._tokens + (now - self._timestamp) * self.rate,
+                    )
+                    self._timestamp = now
+
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+
+                    timeout = (1 - self._tokens) / self.rate
+
+            time.sleep(timeout)
+
+
+class LruTtlCache:
+    """
+    Словарь ограниченного размера: при переполнении удаляется давно не использованный
+    элемент, а элементы старше ttl секунд считаются отсутствующими
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._items: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self._items[key]
+
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._items[key] = time.monotonic() + self.ttl, value
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def get_stats(self) -> dict[str, Union[int, float]]:
+        with self._lock:
+            total = self.hits + self.misses
+            return dict(
+                items=len(self._items),
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / total if total else 0.0,
+            )
+
+
+class ProcessLock:
+    """
+    Межпроцессная блокировка на файле. Ее держит ОС, поэтому после завершения
+    процесса, в том числе аварийного, блокировка снимается сама
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._file = None
+
+    def acquire(self) -> bool:
+        """
+        Захват блокировки без ожидания. Возвращает False, если ее держит другой процесс
+        """
+
+        if self._file:
+            return True
+
+        file = open(self.path, "a+b")
+        try:
+            if sys.platform == "win32":
+                import msvcrt
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        except OSError:
+            file.close()
+            return False
+
+        self._file = file
+        return True
+
+    def release(self):
+        if not self._file:
+            return
+
+        file, self._file = self._file, None
+        if sys.platform == "win32":
+            import msvcrt
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+        file.close()
+
+
 def get_logger(
     name: str,
     file: Union[str, Path] = "log.txt",
@@ -23,19 +23,32 @@ DB_DIR_NAME.mkdir(parents=True, exist_ok=True)
 # Путь к файлу базы данных
 DB_FILE_NAME = str(DB_DIR_NAME / "database.sqlite")
 
+# Файл блокировки, которую держит запущенный бот
+BOT_LOCK_FILE_NAME = DB_DIR_NAME / "bot.lock"
+
 TOKEN_FILE_NAME = DIR / "TOKEN.txt"
 
-try:
-    TOKEN = os.environ.get("TOKEN") or TOKEN_FILE_NAME.read_text("utf-8").strip()
-    if not TOKEN:
-        raise Exception("TOKEN пустой!")
 
-except:
-    print(
-        f"Нужно в {TOKEN_FILE_NAME.name} или в переменную окружения TOKEN добавить токен бота"
-    )
-    TOKEN_FILE_NAME.touch()
-    sys.exit()
+def get_token() -> str:
+    """
+    Токен читается при первом обращении, а не при импорте, чтобы модули,
+    которым токен не нужен (парсер, скрипты), не завершали работу без него
+    """
+
+    try:
+        token = os.environ.get("TOKEN") or TOKEN_FILE_NAME.read_text("utf-8").strip()
+        if not token:
+            raise Exception("TOKEN пустой!")
+
+        return token
+
+    except:
+        print(
+            f"Нужно в {TOKEN_FILE_NAME.name} или в переменную окружения TOKEN добавить токен бота"
+        )
+        TOKEN_FILE_NAME.touch()
+        sys.exit()
+
 
 USER_NAME_ADMINS = [
     "@ilya_petrash",
@@ -52,3 +65,24 @@ DEFAULT_CURRENCY_CHAR_CODES = [
 ]
 
 DATE_FORMAT: str = "%d/%m/%Y"
+
+# Кэш отрисованных графиков: ограничение по памяти и папка для вытесненных графиков
+CHART_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+CHART_CACHE_SPILL_TO_DISK: bool = False
+DIR_CHART_CACHE: Path = DIR / "chart_cache"
+
+# Пул процессов для отрисовки графиков. При RENDER_PROCESSES = 0 графики рисуются в потоке запроса
+RENDER_PROCESSES: int = os.cpu_count() or 1
+RENDER_QUEUE_SIZE: int = 32
+RENDER_SUBMIT_TIMEOUT: float = 10
+RENDER_JOB_TIMEOUT: float = 60
+
+# Графики с таким количеством записей рисуются упрощенно, без matplotlib
+LIGHTWEIGHT_CHART_NUMBERS: tuple[int, ...] = (7, 30)
+
+# Графики с большим количеством записей прореживаются до этого количества точек
+CHART_DOWNSAMPLE_THRESHOLD: int = 1000
+
+# Прогрев кэша графиков после добавления новых курсов
+WARM_UP_CHARTS_WORKERS: int = 2
+WARM_UP_CHARTS_MAX_NUMBER: int = 30
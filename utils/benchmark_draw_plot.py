@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Сравнение скорости отрисовки графиков на 7 и 30 точек через matplotlib (draw_plot)
+# и через Pillow (draw_plot_lightweight), а также времени импорта обоих вариантов.
+# Запуск: python utils/benchmark_draw_plot.py
+
+
+import subprocess
+import sys
+import timeit
+from io import BytesIO
+
+from utils.draw_plot import draw_plot
+from utils.draw_plot_lightweight import draw_plot_lightweight, get_test_series
+
+
+def get_import_time(module: str) -> float:
+    # Отдельный процесс, чтобы модули еще не были загружены
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return float(result.stdout)
+
+
+def run(number: int = 50):
+    for module in ("matplotlib.figure", "PIL.ImageDraw"):
+        print(f"Импорт {module}: {get_import_time(module) * 1000:.0f} мс")
+
+    print()
+
+    for points in (7, 30):
+        days, values = get_test_series(points)
+
+        results = dict()
+        for name, func in [
+            ("matplotlib", draw_plot),
+            ("lightweight", draw_plot_lightweight),
+        ]:
+            elapsed = timeit.timeit(
+                lambda: func(BytesIO(), days, values, title="title"),
+                number=number,
+            )
+            results[name] = elapsed
+            print(f"{points} точек, {name:11}: {elapsed / number * 1000:.1f} мс на график")
+
+        print(f"Ускорение: x{results['matplotlib'] / results['lightweight']:.1f}")
+        print()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Пропускная способность отрисовки графиков при одновременных запросах:
+# в потоках одного процесса (как раньше в потоках бота) и в пуле из 1..N процессов.
+# Запуск: python utils/benchmark_render.py [<количество графиков>]
+
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+from utils.draw_plot import render_png
+from utils.render_service import RenderService
+
+
+def run(jobs: int = 32, threads: int = 16):
+    rates = db.ExchangeRate.get_last_rates(currency_char_code="USD", number=-1)
+    days = [rate.date for rate in rates]
+    values = [rate.value for rate in rates]
+    print(f"Графиков: {jobs}, точек в графике: {len(days)}, потоков-клиентов: {threads}")
+
+    def measure(render) -> float:
+        t = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(lambda _: render(days, values, "title"), range(jobs)))
+        return time.perf_counter() - t
+
+    elapsed = measure(render_png)
+    print(f"{'Потоки':10}: {jobs / elapsed:6.1f} графиков в секунду")
+
+    for processes in range(1, (os.cpu_count() or 1) + 1):
+        service = RenderService(processes=processes, queue_size=jobs)
+
+        # Запуск процессов не должен попасть в замер
+        for future in [service.submit(days, values) for _ in range(processes)]:
+            future.result()
+
+        elapsed = measure(service.render)
+        print(f"{f'Процессов {processes}':10}: {jobs / elapsed:6.1f} графиков в секунду")
+
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    db.init()
+    run(jobs=int(sys.argv[1]) if len(sys.argv) > 1 else 32)
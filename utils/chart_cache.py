@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as DT
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Hashable, Optional
+
+
+class ChartCache:
+    """
+    LRU-кэш отрисованных графиков (PNG) с ограничением по суммарному размеру.
+
+    Ключ должен содержать дату последнего курса, поэтому устаревшие графики
+    никогда не возвращаются. При смене этой даты кэш очищается целиком.
+    Если задана spill_dir, вытесненные из памяти графики сохраняются на диск
+    и при следующем обращении поднимаются обратно в память. Дата последнего курса
+    входит в имя файла, поэтому файлы от прошлого запуска или другого процесса
+    с устаревшими данными не будут прочитаны
+    """
+
+    def __init__(self, max_bytes: int, spill_dir: Optional[Path] = None):
+        self.max_bytes = max_bytes
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+
+        self._data_by_key: OrderedDict[Hashable, bytes] = OrderedDict()
+        self._size: int = 0
+        self._last_date: Optional[DT.date] = None
+        self._lock = threading.Lock()
+
+        self.hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+
+    def _get_spill_path(self, key: Hashable) -> Path:
+        name = hashlib.md5(repr((self._last_date, key)).encode("utf-8")).hexdigest()
+        return self.spill_dir / f"{name}.png"
+
+    def _clear_spill_dir(self):
+        if not self.spill_dir or not self.spill_dir.exists():
+            return
+
+        for path in self.spill_dir.glob("*.png"):
+            path.unlink(missing_ok=True)
+
+    def _check_last_date(self, last_date: DT.date):
+        if self._last_date == last_date:
+            return
+
+        # Первое обращение после запуска: файлы на диске с той же датой еще актуальны
+        if self._last_date is not None:
+            self.invalidations += 1
+            self._clear_spill_dir()
+
+        self._last_date = last_date
+        self._data_by_key.clear()
+        self._size = 0
+
+    def _put(self, key: Hashable, data: bytes):
+        old_data = self._data_by_key.pop(key, None)
+        if old_data is not None:
+            self._size -= len(old_data)
+
+        # Слишком большой график не поместится, как ни вытесняй
+        if len(data) > self.max_bytes:
+            return
+
+        self._data_by_key[key] = data
+        self._size += len(data)
+
+        while self._size > self.max_bytes:
+            evicted_key, evicted_data = self._data_by_key.popitem(last=False)
+            self._size -= len(evicted_data)
+            self.evictions += 1
+
+            if self.spill_dir:
+                self.spill_dir.mkdir(parents=True, exist_ok=True)
+                self._get_spill_path(evicted_key).write_bytes(evicted_data)
+
+    def get(self, key: Hashable, last_date: DT.date) -> Optional[bytes]:
+        with self._lock:
+            self._check_last_date(last_date)
+
+            data = self._data_by_key.get(key)
+            if data is not None:
+                self._data_by_key.move_to_end(key)
+                self.hits += 1
+                return data
+
+            if self.spill_dir:
+                path = self._get_spill_path(key)
+                if path.exists():
+                    data = path.read_bytes()
+                    path.unlink(missing_ok=True)
+                    self._put(key, data)
+                    self.disk_hits += 1
+                    return data
+
+            self.misses += 1
+            return
+
+    def put(self, key: Hashable, last_date: DT.date, data: bytes):
+        with self._lock:
+            # Пока рисовался график, могли прийти новые курсы
+            if self._last_date and last_date < self._last_date:
+                return
+
+            self._check_last_date(last_date)
+            self._put(key, data)
+
+    def clear(self):
+        with self._lock:
+            self._data_by_key.clear()
+            self._size = 0
+            self._last_date = None
+            self._clear_spill_dir()
+
+    def get_stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(
+                items=len(self._data_by_key),
+                size=self._size,
+                hits=self.hits,
+                disk_hits=self.disk_hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                invalidations=self.invalidations,
+            )
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    date_1 = DT.date(2022, 4, 1)
+    date_2 = DT.date(2022, 4, 2)
+
+    cache = ChartCache(max_bytes=10)
+    assert cache.get("a", date_1) is None
+    cache.put("a", date_1, b"12345")
+    cache.put("b", date_1, b"12345")
+    assert cache.get("a", date_1) == b"12345"
+
+    # "b" давно не запрашивался и будет вытеснен
+    cache.put("c", date_1, b"12345")
+    assert cache.get("b", date_1) is None
+    assert cache.get("a", date_1) == b"12345"
+    assert cache.get_stats()["evictions"] == 1
+
+    # Новая дата последнего курса сбрасывает кэш
+    assert cache.get("a", date_2) is None
+    assert cache.get_stats()["items"] == 0
+    assert cache.get_stats()["invalidations"] == 1
+
+    # Результат отрисовки по старой дате не сохраняется
+    cache.put("a", date_1, b"12345")
+    assert cache.get("a", date_2) is None
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        cache = ChartCache(max_bytes=10, spill_dir=Path(dir_path))
+        cache.put("a", date_1, b"12345")
+        cache.put("b", date_1, b"12345")
+        cache.put("c", date_1, b"12345")
+        assert cache.get("a", date_1) == b"12345"
+        assert cache.get_stats()["disk_hits"] == 1
+
+        # Новый экземпляр (например, после перезапуска) не удаляет файлы
+        # и читает только те, что сохранены для той же даты
+        cache = ChartCache(max_bytes=10, spill_dir=Path(dir_path))
+        assert cache.get("b", date_1) == b"12345"
+        cache.put("c", date_1, b"12345")
+        cache.put("d", date_1, b"12345")
+        assert len(list(Path(dir_path).glob("*.png"))) == 1
+
+        cache = ChartCache(max_bytes=10, spill_dir=Path(dir_path))
+        assert cache.get("b", date_2) is None
+        assert cache.get_stats()["disk_hits"] == 0
+
+        # Смена даты внутри процесса удаляет устаревшие файлы
+        cache = ChartCache(max_bytes=10, spill_dir=Path(dir_path))
+        cache.get("a", date_1)
+        cache.get("a", date_2)
+        assert not list(Path(dir_path).glob("*.png"))
+
+    print(cache.get_stats())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+from typing import Sequence
+
+# pip install numpy
+import numpy as np
+
+
+# SOURCE: https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf (Largest-Triangle-Three-Buckets)
+def lttb_indices(x: Sequence[float], y: Sequence[float], threshold: int) -> np.ndarray:
+    """
+    Индексы точек, которые сохраняют форму графика при уменьшении количества точек до threshold.
+    Первая и последняя точки сохраняются всегда, остальные точки делятся на threshold - 2
+    корзины, и из каждой берется точка, образующая треугольник наибольшей площади
+    с предыдущей выбранной точкой и средней точкой следующей корзины
+    """
+
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # Границы корзин, последняя точка в корзины не входит
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    counts = np.diff(edges)
+
+    # Средние точки всех корзин считаются сразу, для последней корзины "следующей" будет последняя точка
+    avg_x = np.add.reduceat(x[:n - 1], edges[:-1]) / counts
+    avg_y = np.add.reduceat(y[:n - 1], edges[:-1]) / counts
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+
+        areas = np.abs(
+            (x[a] - next_x[i]) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (next_y[i] - y[a])
+        )
+        a = start + int(areas.argmax())
+        indices[i + 1] = a
+
+    return indices
+
+
+if __name__ == "__main__":
+    import time
+
+    assert list(lttb_indices([1, 2, 3], [1, 2, 3], threshold=10)) == [0, 1, 2]
+
+    # Пики сохраняются
+    x = np.arange(100)
+    y = np.zeros(100)
+    y[37] = 10
+    y[71] = -10
+    indices = lttb_indices(x, y, threshold=10)
+    assert 37 in indices and 71 in indices
+    assert indices[0] == 0 and indices[-1] == 99
+
+    rng = np.random.default_rng(0)
+    for n in (6_000, 60_000):
+        x = np.arange(n)
+        y = np.cumsum(rng.normal(size=n))
+
+        t = time.perf_counter()
+        indices = lttb_indices(x, y, threshold=1_000)
+        elapsed = time.perf_counter() - t
+
+        assert len(indices) == 1_000
+        assert np.all(np.diff(indices) > 0)
+        print(f"{n} -> {len(indices)} точек за {elapsed * 1000:.1f} мс")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as DT
+from decimal import Decimal
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Union
+
+# pip install matplotlib
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+
+from root_config import DATE_FORMAT
+
+
+# SOURCE: https://github.com/gil9red/get_metal_rates/blob/480a9866194578b732bf6c64666784a031e98035/utils/draw_plot.py#L23
+def draw_plot(
+    out: Union[str, Path, BinaryIO],
+    days: list[DT.date],
+    values: list[Decimal],
+    locator: mdates.DateLocator = None,
+    title: str = None,
+    color: str = "",
+    date_format: str = DATE_FORMAT,
+    axis_off: bool = False,
+):
+    if not locator:
+        locator = mdates.AutoDateLocator()
+
+    fig = Figure()
+    ax = fig.subplots()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter(date_format))
+    ax.xaxis.set_major_locator(locator)
+
+    lines = ax.plot(days, values)[0]
+    if color:
+        lines.set_color(color)
+
+    if title:
+        ax.set_xlabel(title)
+
+    fig.autofmt_xdate()
+
+    if axis_off:
+        ax.set_xticks([])
+        ax.set_yticks([])
+
+    fig.savefig(out, format="png")
+
+    # После записи в файловый объект нужно внутренний указатель переместить в начало, иначе read не будет работать
+    if hasattr(out, "seek"):  # Для BinaryIO и ему подобных
+        out.seek(0)
+
+
+def render_png(days: list[DT.date], values: list[Decimal], title: str = None) -> bytes:
+    """
+    Отрисовка графика в PNG. Функция выполняется в процессах RenderService
+    """
+
+    bytes_io = BytesIO()
+    draw_plot(
+        out=bytes_io,
+        days=days,
+        values=values,
+        title=title,
+    )
+    return bytes_io.getvalue()
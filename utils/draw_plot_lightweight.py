@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Упрощенная отрисовка графиков на несколько десятков точек без matplotlib.
+# Внешне повторяет draw_plot: размер 640x480, рамка осей, подписи дат под углом,
+# подписи значений слева и заголовок под осью X
+
+
+import datetime as DT
+import importlib.util
+import math
+from decimal import Decimal
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, BinaryIO, Union
+
+# pip install numpy Pillow
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from root_config import DATE_FORMAT
+
+
+DIR = Path(__file__).resolve().parent
+DIR_FIXTURES: Path = DIR / "fixtures"
+
+# Как у matplotlib по умолчанию: figsize=(6.4, 4.8), dpi=100
+WIDTH: int = 640
+HEIGHT: int = 480
+
+# Рисование идет в увеличенном масштабе, а затем картинка уменьшается, чтобы сгладить линии
+SCALE: int = 2
+
+# Границы осей как у matplotlib после fig.autofmt_xdate()
+AXES_LEFT: float = 0.125
+AXES_RIGHT: float = 0.9
+AXES_BOTTOM: float = 0.2
+AXES_TOP: float = 0.88
+AXES_MARGIN: float = 0.05
+
+COLOR_LINE: str = "#1f77b4"
+LINE_WIDTH: float = 2
+FONT_SIZE: int = 13
+TICK_LENGTH: int = 5
+MAX_TICKS: int = 8
+PALETTE_COLORS: int = 64
+
+
+@lru_cache
+def get_font(size: int) -> ImageFont.FreeTypeFont:
+    # Шрифт берется из matplotlib, но сам matplotlib при этом не импортируется
+    spec = importlib.util.find_spec("matplotlib")
+    if spec and spec.origin:
+        path = Path(spec.origin).parent / "mpl-data" / "fonts" / "ttf" / "DejaVuSans.ttf"
+        if path.exists():
+            return ImageFont.truetype(str(path), size)
+
+    return ImageFont.load_default()
+
+
+def get_nice_ticks(min_value: float, max_value: float, max_ticks: int = MAX_TICKS) -> list[float]:
+    """
+    Значения для подписей оси с "круглым" шагом: 1, 2, 2.5 или 5, умноженным на степень 10
+    """
+
+    span = max_value - min_value
+    if span <= 0:
+        return [min_value]
+
+    raw_step = span / max_ticks
+    power = 10 ** math.floor(math.log10(raw_step))
+    for multiplier in (1, 2, 2.5, 5, 10):
+        step = multiplier * power
+        if step >= raw_step:
+            break
+
+    first = math.ceil(min_value / step) * step
+    ticks = []
+    value = first
+    while value <= max_value + step * 1e-9:
+        ticks.append(round(value, 10))
+        value += step
+
+    return ticks
+
+
+def get_tick_label(value: float, ticks: list[float]) -> str:
+    if len(ticks) < 2:
+        return f"{value:g}"
+
+    step = ticks[1] - ticks[0]
+    decimals = max(0, -math.floor(math.log10(step) + 1e-9))
+    if round(step * 10 ** decimals) % 10 and step < 1:
+        decimals += 1
+
+    return f"{value:.{decimals}f}"
+
+
+def get_date_ticks(days: list[DT.date], max_ticks: int = MAX_TICKS) -> list[DT.date]:
+    span = (days[-1] - days[0]).days
+    step = max(1, math.ceil(span / max_ticks))
+    return [days[0] + DT.timedelta(days=i) for i in range(0, span + 1, step)]
+
+
+def draw_text(
+    img: Image.Image,
+    xy: tuple[float, float],
+    text: str,
+    font: ImageFont.FreeTypeFont,
+    anchor: str,
+    angle: float = 0,
+):
+    if not angle:
+        ImageDraw.Draw(img).text(xy, text, font=font, fill="black", anchor=anchor)
+        return
+
+    # Повернутый текст рисуется на отдельной маске. Точка привязки - правый верхний угол
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new("L", (right - left, bottom - top), 0)
+    ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=255)
+    mask = mask.rotate(angle, expand=True, resample=Image.BICUBIC)
+
+    x, y = xy
+    img.paste("black", (int(x - mask.width), int(y)), mask)
+
+
+def draw_plot_lightweight(
+    out: Union[str, Path, BinaryIO],
+    days: list[DT.date],
+    values: list[Decimal],
+    locator: Any = None,  # Для совместимости с draw_plot, не используется
+    title: str = None,
+    color: str = "",
+    date_format: str = DATE_FORMAT,
+    axis_off: bool = False,
+):
+    width, height = WIDTH * SCALE, HEIGHT * SCALE
+
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    font = get_font(FONT_SIZE * SCALE)
+
+    left, right = AXES_LEFT * width, AXES_RIGHT * width
+    top, bottom = (1 - AXES_TOP) * height, (1 - AXES_BOTTOM) * height
+
+    xs = [day.toordinal() for day in days]
+    ys = [float(value) for value in values]
+
+    x_min, x_max = min(xs), max(xs)
+    if x_min == x_max:
+        x_min, x_max = x_min - 1, x_max + 1
+    x_margin = (x_max - x_min) * AXES_MARGIN
+    x_min, x_max = x_min - x_margin, x_max + x_margin
+
+    y_min, y_max = min(ys), max(ys)
+    if y_min == y_max:
+        y_min, y_max = y_min - 1, y_max + 1
+    y_margin = (y_max - y_min) * AXES_MARGIN
+    y_min, y_max = y_min - y_margin, y_max + y_margin
+
+    def to_px(x: float, y: float) -> tuple[float, float]:
+        return (
+            left + (x - x_min) / (x_max - x_min) * (right - left),
+            bottom - (y - y_min) / (y_max - y_min) * (bottom - top),
+        )
+
+    tick_length = TICK_LENGTH * SCALE
+    label_bottom = bottom
+
+    if not axis_off:
+        y_ticks = get_nice_ticks(y_min, y_max)
+        for value in y_ticks:
+            _, y = to_px(x_min, value)
+            draw.line([(left - tick_length, y), (left, y)], fill="black", width=SCALE)
+            draw_text(
+                img, (left - tick_length * 1.5, y), get_tick_label(value, y_ticks), font, anchor="rm"
+            )
+
+        for day in get_date_ticks(days):
+            x, _ = to_px(day.toordinal(), y_min)
+            draw.line([(x, bottom), (x, bottom + tick_length)], fill="black", width=SCALE)
+            draw_text(
+                img, (x, bottom + tick_length * 1.5), day.strftime(date_format), font,
+                anchor="rt", angle=30,
+            )
+
+        # Высота подписей дат под углом 30 градусов
+        left_, top_, right_, bottom_ = font.getbbox(days[0].strftime(date_format))
+        label_bottom = (
+            bottom + tick_length * 1.5
+            + (right_ - left_) * math.sin(math.radians(30))
+            + (bottom_ - top_) * math.cos(math.radians(30))
+        )
+
+    draw.line(
+        [to_px(x, y) for x, y in zip(xs, ys)],
+        fill=color or COLOR_LINE,
+        width=round(LINE_WIDTH * SCALE),
+        joint="curve",
+    )
+    draw.rectangle([left, top, right, bottom], outline="black", width=SCALE)
+
+    if title:
+        draw_text(img, ((left + right) / 2, label_bottom + tick_length), title, font, anchor="mt")
+
+    img = img.reduce(SCALE)
+
+    # На картинке только черный, белый, цвет линии и их смеси после сглаживания,
+    # поэтому палитры хватает, а PNG с палитрой сохраняется быстрее и весит меньше
+    img = img.quantize(PALETTE_COLORS, method=Image.Quantize.FASTOCTREE)
+    img.save(out, format="png")
+
+    # После записи в файловый объект нужно внутренний указатель переместить в начало, иначе read не будет работать
+    if hasattr(out, "seek"):  # Для BinaryIO и ему подобных
+        out.seek(0)
+
+
+def get_test_series(number: int) -> tuple[list[DT.date], list[Decimal]]:
+    days = [DT.date(2022, 3, 1) + DT.timedelta(days=i) for i in range(number)]
+    values = [Decimal(str(round(80 + 5 * math.sin(i / 3) + i / 10, 4))) for i in range(number)]
+    return days, values
+
+
+def get_diff_ratio(path_1: Union[Path, BinaryIO], path_2: Union[Path, BinaryIO], tolerance: int = 32) -> float:
+    """
+    Доля пикселей, которые отличаются больше чем на tolerance хотя бы в одном канале
+    """
+
+    img_1 = np.asarray(Image.open(path_1).convert("RGB"), dtype=np.int16)
+    img_2 = np.asarray(Image.open(path_2).convert("RGB"), dtype=np.int16)
+    if img_1.shape != img_2.shape:
+        return 1.0
+
+    diff = (np.abs(img_1 - img_2) > tolerance).any(axis=2)
+    return float(diff.mean())
+
+
+if __name__ == "__main__":
+    import sys
+    from io import BytesIO
+
+    # Проверка, что картинки не изменились относительно сохраненных эталонов.
+    # Для обновления эталонов: python utils/draw_plot_lightweight.py --update
+    update = "--update" in sys.argv
+    if update:
+        DIR_FIXTURES.mkdir(parents=True, exist_ok=True)
+
+    for number in (7, 30):
+        days, values = get_test_series(number)
+        title = f"Тестовый график на {number} точек"
+
+        bytes_io = BytesIO()
+        draw_plot_lightweight(bytes_io, days, values, title=title)
+
+        path = DIR_FIXTURES / f"draw_plot_lightweight_{number}.png"
+        if update:
+            path.write_bytes(bytes_io.getvalue())
+            print(f"Сохранен эталон {path}")
+            continue
+
+        assert path.exists(), f"Нет эталона {path}, для создания запустите с --update"
+
+        ratio = get_diff_ratio(path, bytes_io)
+        print(f"{path.name}: отличается {ratio:.2%} пикселей")
+        assert ratio < 0.005, f"Картинка {path.name} заметно изменилась"
+
+    assert get_nice_ticks(0, 10) == [0, 2, 4, 6, 8, 10]
+    assert get_nice_ticks(80.1, 81.9) == [80.25, 80.5, 80.75, 81.0, 81.25, 81.5, 81.75]
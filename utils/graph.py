@@ -4,58 +4,43 @@
 __author__ = "ipetrash"
 
 
-import datetime as DT
-from decimal import Decimal
+import threading
+from collections import Counter
 from io import BytesIO
 from pathlib import Path
-from typing import BinaryIO, Union
-
-# pip install matplotlib
-import matplotlib.dates as mdates
-from matplotlib.figure import Figure
+from typing import Optional
 
 import db
-from root_config import DATE_FORMAT
-from root_common import get_date_str
-
+from root_config import (
+    CHART_CACHE_MAX_BYTES,
+    CHART_CACHE_SPILL_TO_DISK,
+    DIR_CHART_CACHE,
+    LIGHTWEIGHT_CHART_NUMBERS,
+    CHART_DOWNSAMPLE_THRESHOLD,
+)
+from root_common import get_date_str, get_start_date, get_end_date
+from utils.chart_cache import ChartCache
+from utils.render_service import render_service
 
-# SOURCE: https://github.com/gil9red/get_metal_rates/blob/480a9866194578b732bf6c64666784a031e98035/utils/draw_plot.py#L23
-def draw_plot(
-    out: Union[str, Path, BinaryIO],
-    days: list[DT.date],
-    values: list[Decimal],
-    locator: mdates.DateLocator = None,
-    title: str = None,
-    color: str = "",
-    date_format: str = DATE_FORMAT,
-    axis_off: bool = False,
-):
-    if not locator:
-        locator = mdates.AutoDateLocator()
 
-    fig = Figure()
-    ax = fig.subplots()
-    ax.xaxis.set_major_formatter(mdates.DateFormatter(date_format))
-    ax.xaxis.set_major_locator(locator)
+chart_cache = ChartCache(
+    max_bytes=CHART_CACHE_MAX_BYTES,
+    spill_dir=DIR_CHART_CACHE if CHART_CACHE_SPILL_TO_DISK else None,
+)
 
-    lines = ax.plot(days, values)[0]
-    if color:
-        lines.set_color(color)
+# Сколько раз пользователи запрашивали график с параметрами (валюта, number, year)
+chart_requests: Counter[tuple[str, int, Optional[int]]] = Counter()
+chart_requests_lock = threading.Lock()
 
-    if title:
-        ax.set_xlabel(title)
 
-    fig.autofmt_xdate()
+def add_chart_request(currency_char_code: str, number: int = -1, year: int = None):
+    with chart_requests_lock:
+        chart_requests[currency_char_code, number, year] += 1
 
-    if axis_off:
-        ax.set_xticks([])
-        ax.set_yticks([])
 
-    fig.savefig(out, format="png")
-
-    # После записи в файловый объект нужно внутренний указатель переместить в начало, иначе read не будет работать
-    if hasattr(out, "seek"):  # Для BinaryIO и ему подобных
-        out.seek(0)
+def get_popular_chart_requests(limit: int) -> list[tuple[str, int, Optional[int]]]:
+    with chart_requests_lock:
+        return [key for key, _ in chart_requests.most_common(limit)]
 
 
 def get_plot_for_currency(
@@ -64,38 +49,70 @@ def get_plot_for_currency(
     year: int = None,
     title_format: str = "Стоимость {currency_char_code} в рублях за {start_date} - {end_date}",
 ) -> BytesIO:
+    # numpy и Pillow нужны только для графиков, поэтому импортируются при первом вызове
+    from utils.downsampling import lttb_indices
+    from utils.draw_plot_lightweight import draw_plot_lightweight
+    from utils.series_store import series_store
+
+    # График полностью определяется параметрами и датой последнего курса
+    last_date = db.ExchangeRate.get_last_date()
+    key = currency_char_code, number, year, title_format
+
+    data = chart_cache.get(key, last_date)
+    if data is not None:
+        return BytesIO(data)
+
     if year:
-        rates = db.ExchangeRate.get_all_by_year(
-            currency_char_code=currency_char_code, year=year
+        dates, values = series_store.series(
+            currency_char_code=currency_char_code,
+            start_date=get_start_date(year),
+            end_date=get_end_date(year),
         )
     else:
-        rates = db.ExchangeRate.get_last_rates(
+        dates, values = series_store.last_n(
             currency_char_code=currency_char_code, number=number
         )
 
-    days = []
-    values = []
-    for rate in rates:
-        days.append(rate.date)
-        values.append(rate.value)
-
     title = title_format.format(
         currency_char_code=currency_char_code,
-        start_date=get_date_str(days[0]),
-        end_date=get_date_str(days[-1]),
+        start_date=get_date_str(dates[0].item()),
+        end_date=get_date_str(dates[-1].item()),
     )
 
-    bytes_io = BytesIO()
-    draw_plot(
-        out=bytes_io,
-        days=days,
-        values=values,
-        title=title,
-    )
-    return bytes_io
+    # На картинку в несколько сотен пикселей в ширину все точки за все время не нужны
+    if len(dates) > CHART_DOWNSAMPLE_THRESHOLD:
+        indices = lttb_indices(
+            x=dates.astype("int64"),
+            y=values,
+            threshold=CHART_DOWNSAMPLE_THRESHOLD,
+        )
+        dates = dates[indices]
+        values = values[indices]
+
+    days = dates.tolist()
+    values = values.tolist()
+
+    if not year and number in LIGHTWEIGHT_CHART_NUMBERS:
+        # Маленький график быстрее нарисовать на месте, чем передавать в другой процесс
+        bytes_io = BytesIO()
+        draw_plot_lightweight(
+            out=bytes_io,
+            days=days,
+            values=values,
+            title=title,
+        )
+        data = bytes_io.getvalue()
+    else:
+        # Отрисовка выполняется в отдельном процессе, чтобы не занимать GIL потоков бота
+        data = render_service.render(days=days, values=values, title=title)
+    chart_cache.put(key, last_date, data)
+
+    return BytesIO(data)
 
 
 if __name__ == "__main__":
+    db.init()
+
     current_dir = Path(__file__).resolve().parent
     images_dir = current_dir / "chart_images"
     images_dir.mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as DT
+import multiprocessing
+import sys
+import threading
+import types
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from decimal import Decimal
+
+from root_config import (
+    RENDER_PROCESSES,
+    RENDER_QUEUE_SIZE,
+    RENDER_SUBMIT_TIMEOUT,
+    RENDER_JOB_TIMEOUT,
+)
+from utils.render_worker import render_png
+
+
+_main_module_lock = threading.Lock()
+
+
+@contextmanager
+def _without_main_module():
+    # При spawn новый процесс заново импортирует __main__ родителя, т.е. скрипт бота
+    # вместе с db, telegram и bot.commands. Процессы пула создаются внутри
+    # executor.submit, и на это время __main__ подменяется пустым модулем,
+    # поэтому в них загружается только то, что нужно для отрисовки
+    with _main_module_lock:
+        main_module = sys.modules["__main__"]
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            yield
+        finally:
+            sys.modules["__main__"] = main_module
+
+
+class RenderServiceBusyError(Exception):
+    pass
+
+
+class RenderService:
+    """
+    Отрисовка графиков в пуле процессов.
+
+    Одновременно в работе и в очереди может быть не больше processes + queue_size
+    задач. Если места нет дольше submit_timeout, отрисовка отклоняется с
+    RenderServiceBusyError, а не копится в памяти. Результат ожидается не дольше
+    job_timeout, при этом зависшая задача продолжает занимать место в очереди,
+    пока процесс ее не закончит.
+    При processes=0 отрисовка выполняется в вызывающем потоке
+    """
+
+    def __init__(
+        self,
+        processes: int = RENDER_PROCESSES,
+        queue_size: int = RENDER_QUEUE_SIZE,
+        submit_timeout: float = RENDER_SUBMIT_TIMEOUT,
+        job_timeout: float = RENDER_JOB_TIMEOUT,
+    ):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.submit_timeout = submit_timeout
+        self.job_timeout = job_timeout
+
+        self._executor: ProcessPoolExecutor = None
+        self._slots = threading.BoundedSemaphore(processes + queue_size)
+        self._lock = threading.Lock()
+
+        self.submitted: int = 0
+        self.completed: int = 0
+        self.rejected: int = 0
+        self.timeouts: int = 0
+        self.errors: int = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if not self._executor:
+                # spawn, а не fork, т.к. процесс бота многопоточный
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+
+            return self._executor
+
+    def _reset_executor(self, executor: ProcessPoolExecutor):
+        if not executor:
+            return
+
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _on_done(self, future: Future):
+        self._slots.release()
+
+        with self._lock:
+            if future.cancelled() or future.exception():
+                self.errors += 1
+            else:
+                self.completed += 1
+
+    def submit(self, days: list[DT.date], values: list[Decimal], title: str = None) -> Future:
+        if not self._slots.acquire(timeout=self.submit_timeout):
+            with self._lock:
+                self.rejected += 1
+            raise RenderServiceBusyError(
+                f"Очередь отрисовки переполнена ({self.processes + self.queue_size} задач)"
+            )
+
+        try:
+            executor = self._get_executor()
+            with _without_main_module():
+                try:
+                    future = executor.submit(render_png, days, values, title)
+                except BrokenProcessPool:
+                    self._reset_executor(executor)
+                    future = self._get_executor().submit(render_png, days, values, title)
+
+        except BaseException as e:
+            self._slots.release()
+            raise e
+
+        with self._lock:
+            self.submitted += 1
+
+        future.add_done_callback(self._on_done)
+        return future
+
+    def render(self, days: list[DT.date], values: list[Decimal], title: str = None) -> bytes:
+        if not self.processes:
+            return render_png(days, values, title)
+
+        future = self.submit(days, values, title)
+        try:
+            return future.result(timeout=self.job_timeout)
+
+        except TimeoutError as e:
+            with self._lock:
+                self.timeouts += 1
+            raise e
+
+        except BrokenProcessPool as e:
+            # Процесс пула упал, следующие задачи пойдут в новый пул
+            self._reset_executor(self._executor)
+            raise e
+
+    def get_stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(
+                processes=self.processes,
+                in_progress=self.submitted - self.completed - self.errors,
+                submitted=self.submitted,
+                completed=self.completed,
+                rejected=self.rejected,
+                timeouts=self.timeouts,
+                errors=self.errors,
+            )
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor:
+            executor.shutdown(wait=True)
+
+
+render_service = RenderService()
+
+
+if __name__ == "__main__":
+    days = [DT.date(2022, 4, 1) + DT.timedelta(days=i) for i in range(30)]
+    values = [Decimal(80 + i % 7) for i in range(30)]
+
+    service = RenderService(processes=2, queue_size=0, submit_timeout=0.1)
+    data = service.render(days, values, "title")
+    assert data.startswith(b"\x89PNG")
+    assert data == render_png(days, values, "title")
+
+    # Пока обе задачи выполняются, третья не помещается в очередь
+    futures = [service.submit(days, values) for _ in range(2)]
+    try:
+        service.submit(days, values)
+        raise AssertionError("Ожидалось RenderServiceBusyError")
+    except RenderServiceBusyError:
+        pass
+
+    for future in futures:
+        assert future.result()
+
+    print(service.get_stats())
+    service.shutdown()
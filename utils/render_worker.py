@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Код, который выполняется в процессах пула отрисовки. Модуль не должен
+# импортировать db, telegram и код бота, чтобы процессы пула оставались легкими
+
+
+import datetime as DT
+from decimal import Decimal
+
+
+def render_png(days: list[DT.date], values: list[Decimal], title: str = None) -> bytes:
+    # matplotlib импортируется долго, поэтому загружается только в процессах пула
+    # или при первой отрисовке в текущем процессе
+    from utils.draw_plot import render_png
+    return render_png(days, values, title)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as DT
+import threading
+
+# pip install numpy
+import numpy as np
+
+import db
+
+
+Series = tuple[np.ndarray, np.ndarray]
+
+
+class SeriesStore:
+    """
+    Курсы валют по колонкам: для каждой валюты массив дат (datetime64[D])
+    и массив значений (float64), отсортированные по дате.
+
+    Колонки строятся из db.rates_cache и перестраиваются при первом обращении
+    после того, как в rates_cache появились новые строки. Поэтому данные всегда
+    не старее последней даты, которую вернул rates_cache перед обращением.
+    Массивы хранятся в дополнение к спискам rates_cache, а не вместо них
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        # Код валюты -> версия rates_cache, даты, значения
+        self._series_by_code: dict[str, tuple[int, np.ndarray, np.ndarray]] = dict()
+
+    def _build(self, currency_char_code: str) -> tuple[int, np.ndarray, np.ndarray]:
+        version, dates, values = db.rates_cache.get_columns(currency_char_code)
+        item = (
+            version,
+            np.array(dates, dtype="datetime64[D]"),
+            np.array([float(value) for value in values], dtype=np.float64),
+        )
+
+        with self._lock:
+            self._series_by_code[currency_char_code] = item
+
+        return item
+
+    def refresh(self) -> int:
+        """
+        Построение колонок всех валют. Возвращает количество записей
+        """
+
+        return sum(
+            len(self._build(currency_char_code)[1])
+            for currency_char_code in db.rates_cache.get_currency_char_codes()
+        )
+
+    def _get(self, currency_char_code: str) -> Series:
+        version = db.rates_cache.get_version()
+
+        with self._lock:
+            item = self._series_by_code.get(currency_char_code)
+
+        if not item or item[0] != version:
+            item = self._build(currency_char_code)
+
+        _, dates, values = item
+        return dates, values
+
+    def series(
+        self,
+        currency_char_code: str,
+        start_date: DT.date = None,
+        end_date: DT.date = None,
+    ) -> Series:
+        """
+        Даты и значения за период, включая границы.
+        Возвращаются срезы внутренних массивов, их нельзя изменять
+        """
+
+        dates, values = self._get(currency_char_code)
+
+        start = np.searchsorted(dates, np.datetime64(start_date, "D"), side="left") if start_date else 0
+        end = np.searchsorted(dates, np.datetime64(end_date, "D"), side="right") if end_date else len(dates)
+        return dates[start:end], values[start:end]
+
+    def last_n(self, currency_char_code: str, number: int = -1) -> Series:
+        """
+        Последние number записей валюты, при number=-1 все записи
+        """
+
+        dates, values = self._get(currency_char_code)
+        if number < 0:
+            return dates, values
+
+        return dates[-number:], values[-number:]
+
+    def get_nbytes(self) -> int:
+        with self._lock:
+            return sum(
+                dates.nbytes + values.nbytes
+                for _, dates, values in self._series_by_code.values()
+            )
+
+
+series_store = SeriesStore()
+
+
+if __name__ == "__main__":
+    import gc
+    import time
+    import tracemalloc
+    from decimal import Decimal
+
+    db.init()
+
+    # Сравнение памяти: все записи моделями peewee против колонок numpy
+    gc.collect()
+    tracemalloc.start()
+    t = time.perf_counter()
+    rates = list(db.ExchangeRate.select())
+    elapsed = time.perf_counter() - t
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"ExchangeRate: {len(rates)} объектов, {size / 1024:.0f} КБ, {elapsed * 1000:.0f} мс")
+
+    del rates
+
+    # Колонки строятся поверх rates_cache, поэтому в замер входит и его загрузка
+    db.ExchangeRate.clear_cache()
+
+    gc.collect()
+    tracemalloc.start()
+    t = time.perf_counter()
+    store = SeriesStore()
+    number = store.refresh()
+    elapsed = time.perf_counter() - t
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"rates_cache + SeriesStore: {number} записей, всего {size / 1024:.0f} КБ "
+        f"(из них массивы {store.get_nbytes() / 1024:.0f} КБ), {elapsed * 1000:.0f} мс"
+    )
+
+    # Данные должны совпадать с запросами через модели
+    for currency_char_code in db.Currency.get_all_char_codes():
+        dates, values = store.series(currency_char_code)
+        rates = db.rates_cache.get_rates(currency_char_code)
+        assert dates.tolist() == [rate.date for rate in rates], currency_char_code
+        assert values.tolist() == [float(rate.value) for rate in rates], currency_char_code
+
+    last_date = db.ExchangeRate.get_last_date()
+    dates, values = store.last_n("USD", 7)
+    assert len(dates) <= 7 and dates[-1].item() == last_date
+
+    dates, values = store.series("USD", start_date=DT.date(last_date.year, 1, 1))
+    assert all(date.year == last_date.year for date in dates.tolist())
+
+    # После подгрузки новой даты в rates_cache колонки сразу ее содержат, без события о новых курсах
+    new_date = last_date + DT.timedelta(days=1)
+    try:
+        db.ExchangeRate.add_many([(new_date, "USD", Decimal(1))])
+        db.ExchangeRate.refresh_cache()
+
+        dates, values = store.last_n("USD", 1)
+        assert dates[-1].item() == new_date and values[-1] == 1.0
+
+    finally:
+        db.db.submit(db.ExchangeRate.delete().where(db.ExchangeRate.date == new_date))
+        db.db.flush()
+        db.ExchangeRate.clear_cache()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import db
+from root_common import caller_name, get_logger
+from root_config import (
+    DIR_LOGS,
+    DEFAULT_CURRENCY_CHAR_CODES,
+    WARM_UP_CHARTS_WORKERS,
+    WARM_UP_CHARTS_MAX_NUMBER,
+)
+from utils.graph import get_plot_for_currency, get_popular_chart_requests
+
+
+log = get_logger(__file__, DIR_LOGS / "warm_up_charts.txt")
+
+
+def get_charts_for_warm_up(
+    max_number: int = WARM_UP_CHARTS_MAX_NUMBER,
+) -> list[tuple[str, int, Optional[int]]]:
+    """
+    Сначала самые запрашиваемые графики, затем графики для валют по умолчанию
+    за неделю, месяц, все время и текущий год
+    """
+
+    current_year = db.ExchangeRate.get_last_date().year
+
+    items = get_popular_chart_requests(limit=max_number)
+    for currency_char_code in DEFAULT_CURRENCY_CHAR_CODES:
+        for number, year in [(7, None), (30, None), (-1, None), (-1, current_year)]:
+            key = currency_char_code, number, year
+            if key not in items:
+                items.append(key)
+
+    return items[:max_number]
+
+
+def warm_up_charts(
+    workers: int = WARM_UP_CHARTS_WORKERS,
+    max_number: int = WARM_UP_CHARTS_MAX_NUMBER,
+    prefix: str = "[warm_up_charts]",
+) -> int:
+    items = get_charts_for_warm_up(max_number)
+
+    def process(item: tuple[str, int, Optional[int]]) -> bool:
+        currency_char_code, number, year = item
+        try:
+            get_plot_for_currency(
+                currency_char_code=currency_char_code,
+                number=number,
+                year=year,
+            )
+            return True
+        except Exception:
+            log.exception(f"{prefix} Ошибка при отрисовке графика {item}:")
+            return False
+
+    t = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        number = sum(executor.map(process, items))
+
+    log.info(
+        f"{prefix} Отрисовано графиков: {number} из {len(items)} "
+        f"за {time.perf_counter() - t:.1f} секунд"
+    )
+    return number
+
+
+def warming_up_charts():
+    prefix = f"[{caller_name()}]"
+
+    log.info(f"{prefix} Запуск")
+
+    # Номер запоминается до прогрева, чтобы не пропустить событие во время отрисовки
+    event_number = db.new_rates_event.number
+
+    while True:
+        try:
+            warm_up_charts(prefix=prefix)
+        except Exception:
+            log.exception(f"{prefix} Ошибка:")
+
+        event_number = db.new_rates_event.wait(event_number)
+
+
+if __name__ == "__main__":
+    db.init()
+
+    print(get_charts_for_warm_up())
+    warm_up_charts()